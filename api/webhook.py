@@ -1,9 +1,29 @@
 from http.server import BaseHTTPRequestHandler, HTTPServer
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+import csv
+import io
+import itertools
+from array import array
+from bisect import bisect_left
 import json
 import requests
+from requests.adapters import HTTPAdapter
 import os
+import queue
+import re
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+import zlib
+from google.auth.transport.requests import Request as GoogleAuthRequest
 from google.oauth2 import service_account
 from googleapiclient.discovery import build
+from googleapiclient.errors import HttpError
+from googleapiclient.http import HttpRequest
 from datetime import datetime, timezone, timedelta
 
 BOT_TOKEN = os.environ.get("BOT_TOKEN")
@@ -12,12 +32,68 @@ GOOGLE_CREDENTIALS = os.environ.get("GOOGLE_CREDENTIALS")
 
 ALLOWED_USERS = [int(x) for x in os.environ.get("ALLOWED_USERS", "").split(",") if x.strip().isdigit()]
 
-user_states = {}
+LIST_CACHE_TTL = float(os.environ.get("LIST_CACHE_TTL", 60))
+
+# "single" serves one webhook at a time; "threaded" runs SERVER_WORKERS at once
+SERVER_MODE = os.environ.get("SERVER_MODE", "single")
+SERVER_WORKERS = int(os.environ.get("SERVER_WORKERS", 8))
+
+# >0 enables ack-first mode: do_POST enqueues and this many workers process
+UPDATE_QUEUE_WORKERS = int(os.environ.get("UPDATE_QUEUE_WORKERS", 0))
+UPDATE_QUEUE_SIZE = int(os.environ.get("UPDATE_QUEUE_SIZE", 256))
+
+# answer the last reply of a step in the webhook response body (sync mode only)
+INLINE_REPLY = os.environ.get("INLINE_REPLY", "") == "1"
+
+TELEGRAM_CONNECT_TIMEOUT = float(os.environ.get("TELEGRAM_CONNECT_TIMEOUT", 3.05))
+TELEGRAM_READ_TIMEOUT = float(os.environ.get("TELEGRAM_READ_TIMEOUT", 10))
+TELEGRAM_RETRIES = int(os.environ.get("TELEGRAM_RETRIES", 3))
+
+# conversation state: "memory" (per process) or "sqlite" (shared via STATE_DB)
+STATE_BACKEND = os.environ.get("STATE_BACKEND", "memory")
+STATE_DB = os.environ.get("STATE_DB", "states.sqlite3")
+STATE_TTL = float(os.environ.get("STATE_TTL", 3600))
+STATE_MAX_CHATS = int(os.environ.get("STATE_MAX_CHATS", 10000))
+
+# path of the local SQLite write-ahead store; unset keeps Sheets as the database
+LOCAL_STORE = os.environ.get("LOCAL_STORE")
+LOCAL_SYNC = os.environ.get("LOCAL_SYNC", "1") == "1"
+SYNC_INTERVAL = float(os.environ.get("SYNC_INTERVAL", 2))
+SYNC_BATCH = int(os.environ.get("SYNC_BATCH", 500))
+
+# rewrite the Rollup tab after this many new Sheet1 rows (0 = only on demand)
+ROLLUP_PERSIST_ROWS = int(os.environ.get("ROLLUP_PERSIST_ROWS", 1000))
+
+# rows per values.append when importing CSV history
+IMPORT_CHUNK_ROWS = int(os.environ.get("IMPORT_CHUNK_ROWS", 5000))
+
+# Sheet1 rows per read when exporting, and how much CSV stays in memory
+# before the spooled file moves to disk
+EXPORT_PAGE_ROWS = int(os.environ.get("EXPORT_PAGE_ROWS", 5000))
+EXPORT_SPOOL_BYTES = int(os.environ.get("EXPORT_SPOOL_BYTES", 1024 * 1024))
+
+# QuickClean copies Sheet1 into a dated archive tab this many rows at a time
+# before clearing it (0 = clear without archiving)
+CLEAN_CHUNK_ROWS = int(os.environ.get("CLEAN_CHUNK_ROWS", 5000))
+
+# Telegram redelivers an update when the webhook answers slowly; update_ids
+# seen in the last DEDUP_WINDOW seconds (at most DEDUP_SIZE) are dropped.
+# DEDUP_DB keeps them across restarts and processes (empty = memory only)
+DEDUP_WINDOW = float(os.environ.get("DEDUP_WINDOW", 3600))
+DEDUP_SIZE = int(os.environ.get("DEDUP_SIZE", 10000))
+DEDUP_DB = os.environ.get("DEDUP_DB", "")
+
+# >0 holds Sheet1 appends for up to this many ms so transactions finishing
+# together share one values.append; a batch goes early at WRITE_BATCH_ROWS
+WRITE_BATCH_MS = float(os.environ.get("WRITE_BATCH_MS", 0))
+WRITE_BATCH_ROWS = int(os.environ.get("WRITE_BATCH_ROWS", 100))
 
 # ================= UTIL =================
 
+WIB = timezone(timedelta(hours=7))
+
 def now_wib():
-    return datetime.now(timezone(timedelta(hours=7)))
+    return datetime.now(WIB)
 
 def format_currency(amount):
     return f"€{amount:,.0f}"
@@ -68,963 +144,3615 @@ def keyboard_category(items):
     return keyboard
 
 
-def get_service():
-    if not GOOGLE_CREDENTIALS:
-        raise ValueError("GOOGLE_CREDENTIALS environment variable not set")
+# ================= METRICS =================
 
-    credentials_info = json.loads(GOOGLE_CREDENTIALS)
+# Counters and gauges keyed by (name, labels). Histograms keep per-bucket
+# counts plus count and sum, so p50/p95/p99 come from histogram_quantile()
+# on the Prometheus side. /metrics serves render_metrics().
 
-    credentials = service_account.Credentials.from_service_account_info(
-        credentials_info,
-        scopes=["https://www.googleapis.com/auth/spreadsheets"]
-    )
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
 
-    return build("sheets", "v4", credentials=credentials)
+HISTOGRAM_BUCKETS = {
+    "sheets_calls_per_update": (0, 1, 2, 3, 4, 6, 8, 12, 20),
+    "write_batch_rows": (1, 2, 4, 8, 16, 32, 64, 128, 256)
+}
 
+_metrics = {}
+_metric_types = {}
+_metrics_lock = threading.Lock()
 
-def get_sheet(range_name):
-    service = get_service()
 
-    result = service.spreadsheets().values().get(
-        spreadsheetId=SHEET_ID,
-        range=range_name
-    ).execute()
+def metric_inc(name, value=1, **labels):
 
-    return result.get("values", [])
+    key = (name, tuple(sorted(labels.items())))
 
+    with _metrics_lock:
 
-# ================= ACCOUNT =================
+        _metric_types.setdefault(name, "counter")
+        _metrics[key] = _metrics.get(key, 0) + value
 
-def get_accounts():
-    rows = get_sheet("Accounts!A:A")
 
-    if not rows:
-        return []
+def metric_set(name, value, **labels):
 
-    return [r[0].strip() for r in rows[1:] if r and r[0].strip()]
+    key = (name, tuple(sorted(labels.items())))
 
+    with _metrics_lock:
 
-def account_exists(name):
-    return name in get_accounts()
+        _metric_types.setdefault(name, "gauge")
+        _metrics[key] = value
 
 
-def add_account(name):
+def metric_observe(name, value, **labels):
 
-    service = get_service()
+    buckets = HISTOGRAM_BUCKETS.get(name, LATENCY_BUCKETS)
+    key = (name, tuple(sorted(labels.items())))
+    i = bisect_left(buckets, value)
 
-    service.spreadsheets().values().append(
-        spreadsheetId=SHEET_ID,
-        range="Accounts!A:A",
-        valueInputOption="RAW",
-        body={"values": [[name]]}
-    ).execute()
+    with _metrics_lock:
 
+        _metric_types.setdefault(name, "histogram")
 
-def delete_account(name):
+        entry = _metrics.get(key)
 
-    rows = get_sheet("Sheet1!A:F")
+        if entry is None:
+            entry = _metrics[key] = [0] * len(buckets) + [0, 0.0]
 
-    for row in rows[1:]:
+        if i < len(buckets):
+            entry[i] += 1
 
-        if len(row) >= 5 and row[4].strip() == name:
-            return False
+        entry[-2] += 1
+        entry[-1] += value
 
-    acc_rows = get_sheet("Accounts!A:A")
 
-    header = acc_rows[0]
+@contextmanager
+def span(name, **labels):
 
-    remaining = [header]
+    # times the block into the histogram name, also when it raises
 
-    for row in acc_rows[1:]:
+    started = time.perf_counter()
 
-        if row[0].strip() != name:
-            remaining.append(row)
+    try:
+        yield
+    finally:
+        metric_observe(name, time.perf_counter() - started, **labels)
 
-    service = get_service()
 
-    service.spreadsheets().values().clear(
-        spreadsheetId=SHEET_ID,
-        range="Accounts!A2:A"
-    ).execute()
+def format_labels(labels):
 
-    service.spreadsheets().values().update(
-        spreadsheetId=SHEET_ID,
-        range="Accounts!A1",
-        valueInputOption="RAW",
-        body={"values": remaining}
-    ).execute()
+    if not labels:
+        return ""
 
-    return True
+    pairs = []
 
+    for k, v in labels:
 
-# ================= CATEGORY =================
+        v = str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        pairs.append(f'{k}="{v}"')
 
-def get_categories():
+    return "{" + ",".join(pairs) + "}"
 
-    rows = get_sheet("Categories!A:A")
 
-    if not rows:
-        return []
+def render_metrics():
 
-    return [r[0].strip() for r in rows[1:] if r and r[0].strip()]
+    # Prometheus text exposition format, version 0.0.4
 
+    with _metrics_lock:
 
-def category_exists(name):
+        items = sorted(
+            (key, list(value) if isinstance(value, list) else value)
+            for key, value in _metrics.items()
+        )
+        types = dict(_metric_types)
 
-    return name.lower() in [c.lower() for c in get_categories()]
+    lines = []
+    current = None
 
+    for (name, labels), value in items:
 
-def add_category(name):
+        kind = types[name]
 
-    service = get_service()
+        if name != current:
 
-    service.spreadsheets().values().append(
-        spreadsheetId=SHEET_ID,
-        range="Categories!A:A",
-        valueInputOption="RAW",
-        body={"values": [[name]]}
-    ).execute()
+            lines.append(f"# TYPE {name} {kind}")
+            current = name
 
+        if kind != "histogram":
 
-def delete_category(name):
+            lines.append(f"{name}{format_labels(labels)} {value}")
+            continue
 
-    rows = get_sheet("Sheet1!A:F")
+        cumulative = 0
 
-    for row in rows[1:]:
+        for bound, count in zip(HISTOGRAM_BUCKETS.get(name, LATENCY_BUCKETS), value):
 
-        if len(row) >= 4 and row[3].strip().lower() == name.lower():
-            return False
+            cumulative += count
+            lines.append(f"{name}_bucket{format_labels(labels + (('le', bound),))} {cumulative}")
 
-    cat_rows = get_sheet("Categories!A:A")
+        lines.append(f"{name}_bucket{format_labels(labels + (('le', '+Inf'),))} {value[-2]}")
+        lines.append(f"{name}_sum{format_labels(labels)} {value[-1]}")
+        lines.append(f"{name}_count{format_labels(labels)} {value[-2]}")
 
-    header = cat_rows[0]
+    return "".join(line + "\n" for line in lines)
 
-    remaining = [header]
 
-    for row in cat_rows[1:]:
+# ================= EVENTS =================
 
-        if row[0].strip().lower() != name.lower():
-            remaining.append(row)
+# in-process notifications; "transactions_reset" tells the balance and
+# analytics caches that Sheet1 no longer holds what they were built from
 
-    service = get_service()
+_listeners = {}
 
-    service.spreadsheets().values().clear(
-        spreadsheetId=SHEET_ID,
-        range="Categories!A2:A"
-    ).execute()
 
-    service.spreadsheets().values().update(
-        spreadsheetId=SHEET_ID,
-        range="Categories!A1",
-        valueInputOption="RAW",
-        body={"values": remaining}
-    ).execute()
+def on_event(name):
 
-    return True
-    # ================= TRANSACTION =================
+    def register(fn):
+        _listeners.setdefault(name, []).append(fn)
+        return fn
 
-def add_transaction(type_tx, amount, category, account, note=""):
+    return register
 
-    service = get_service()
 
-    service.spreadsheets().values().append(
-        spreadsheetId=SHEET_ID,
-        range="Sheet1!A:F",
-        valueInputOption="RAW",
-        body={
-            "values": [[
-                now_wib().strftime("%Y-%m-%d %H:%M:%S"),
-                type_tx,
-                amount,
-                category,
-                account,
-                note
-            ]]
-        }
-    ).execute()
+def emit(name):
 
+    metric_inc(f"events_{name}_total")
 
-def calculate_account_balance():
+    for fn in _listeners.get(name, []):
+        fn()
 
-    rows = get_sheet("Sheet1!A:F")
 
-    balances = {}
-    total = 0
+# ================= STATE =================
 
-    for row in rows[1:]:
+# Both stores behave like the dict user_states used to be (get, [] =, pop).
+# Handlers mutate the state they got in place, so handle_message() calls
+# commit() afterwards to write those changes back.
 
-        if len(row) < 5:
-            continue
+class MemoryStateStore:
 
-        try:
-            amount = int(float(row[2]))
-        except:
-            continue
+    # LRU bounded to max_chats; entries idle for longer than ttl are dropped
 
-        type_tx = row[1].strip().lower()
-        account = row[4].strip()
+    def __init__(self, ttl, max_chats):
 
-        balances.setdefault(account, 0)
+        self.ttl = ttl
+        self.max_chats = max_chats
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
 
-        if type_tx in ["income", "transfer-in"]:
+    def get(self, chat_id, default=None):
 
-            balances[account] += amount
-            total += amount
+        with self.lock:
 
-        elif type_tx in ["expense", "transfer-out"]:
+            entry = self.entries.get(chat_id)
 
-            balances[account] -= amount
-            total -= amount
+            if entry is None:
+                return default
 
-    for acc in get_accounts():
-        balances.setdefault(acc, 0)
+            if entry[0] <= time.monotonic():
+                del self.entries[chat_id]
+                return default
 
-    return balances, total
+            self.entries.move_to_end(chat_id)
 
+            return entry[1]
 
-# ================= ANALYTICS =================
+    def __setitem__(self, chat_id, state):
 
-def get_all_expense_data():
+        with self.lock:
 
-    rows = get_sheet("Sheet1!A:F")
+            self.entries[chat_id] = (time.monotonic() + self.ttl, state)
+            self.entries.move_to_end(chat_id)
 
-    data = {}
-    total = 0
+            while len(self.entries) > self.max_chats:
+                self.entries.popitem(last=False)
 
-    for row in rows[1:]:
+    def pop(self, chat_id, default=None):
 
-        if len(row) < 5:
-            continue
+        with self.lock:
 
-        if row[1].strip().lower() != "expense":
-            continue
+            entry = self.entries.pop(chat_id, None)
 
-        try:
-            amount = int(float(row[2]))
-        except:
-            continue
+            return default if entry is None else entry[1]
 
-        category = row[3].strip()
+    def commit(self, chat_id):
 
-        total += amount
-        data[category] = data.get(category, 0) + amount
+        with self.lock:
 
-    sorted_data = sorted(data.items(), key=lambda x: x[1], reverse=True)
+            entry = self.entries.get(chat_id)
 
-    return sorted_data, total
+            if entry is not None:
+                self.entries[chat_id] = (time.monotonic() + self.ttl, entry[1])
 
 
-# ================= CLEAN =================
+class SQLiteStateStore:
 
-def quick_clean():
+    # one row of compact JSON per chat; WAL lets several processes share it
 
-    service = get_service()
+    def __init__(self, path, ttl):
 
-    service.spreadsheets().values().clear(
-        spreadsheetId=SHEET_ID,
-        range="Sheet1!A2:Z"
-    ).execute()
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.loaded = {}
+        self.writes = 0
 
+        self.db = sqlite3.connect(path, timeout=10, check_same_thread=False, isolation_level=None)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS states ("
+            "chat_id INTEGER PRIMARY KEY, expires REAL NOT NULL, state TEXT NOT NULL)"
+        )
 
-# ================= TELEGRAM =================
+    def get(self, chat_id, default=None):
 
-def send(chat_id, text, keyboard=None):
+        with self.lock:
 
-    payload = {
-        "chat_id": chat_id,
-        "text": text
-    }
+            row = self.db.execute(
+                "SELECT state FROM states WHERE chat_id = ? AND expires > ?",
+                (chat_id, time.time())
+            ).fetchone()
 
-    if keyboard:
+            if row is None:
+                return default
 
-        payload["reply_markup"] = {
-            "keyboard": keyboard,
-            "resize_keyboard": True
-        }
+            state = json.loads(row[0])
 
-    requests.post(
-        f"https://api.telegram.org/bot{BOT_TOKEN}/sendMessage",
-        json=payload
-    )
+            self.loaded[chat_id] = state
 
+            return state
 
-def main_menu():
+    def __setitem__(self, chat_id, state):
 
-    return [
-        ["Spending","Balance"],
-        ["Income","Transfer","Expense"],
-        ["Management","QuickClean"],
-    ]
+        with self.lock:
 
+            self.loaded[chat_id] = state
+            self.write(chat_id, state)
 
-# ================= HANDLER =================
+    def pop(self, chat_id, default=None):
 
-class handler(BaseHTTPRequestHandler):
+        with self.lock:
 
-    def do_POST(self):
+            state = self.loaded.pop(chat_id, default)
 
-        length = int(self.headers.get('Content-Length', 0))
-        body = self.rfile.read(length)
+            self.db.execute("DELETE FROM states WHERE chat_id = ?", (chat_id,))
 
-        try:
+            return state
 
-            data = json.loads(body)
+    def commit(self, chat_id):
 
-            if "message" not in data:
+        with self.lock:
 
-                self.send_response(200)
-                self.end_headers()
-                return
+            state = self.loaded.pop(chat_id, None)
 
-            message = data.get("message", {})
-            chat_id = message.get("chat", {}).get("id")
-            text = message.get("text", "").strip()
-            user_id = message.get("from", {}).get("id")
+            if state is not None:
+                self.write(chat_id, state)
 
-            if user_id not in ALLOWED_USERS:
+    def write(self, chat_id, state):
 
-                self.send_response(200)
-                self.end_headers()
-                return
+        now = time.time()
 
-            state = user_states.get(chat_id)
+        self.db.execute(
+            "INSERT OR REPLACE INTO states (chat_id, expires, state) VALUES (?, ?, ?)",
+            (chat_id, now + self.ttl, json.dumps(state, separators=(",", ":")))
+        )
 
-            # BACK HANDLER
+        self.writes += 1
 
-            if text == "Back":
+        if self.writes % 100 == 0:
+            self.db.execute("DELETE FROM states WHERE expires <= ?", (now,))
 
-                user_states.pop(chat_id, None)
 
-                send(chat_id, "Back to main menu.", main_menu())
+def make_state_store():
 
-                self.send_response(200)
-                self.end_headers()
-                return
+    if STATE_BACKEND == "memory":
+        return MemoryStateStore(STATE_TTL, STATE_MAX_CHATS)
 
+    if STATE_BACKEND == "sqlite":
+        return SQLiteStateStore(STATE_DB, STATE_TTL)
 
-            if text == "/start":
+    raise ValueError(f"Unknown STATE_BACKEND: {STATE_BACKEND}")
 
-                send(chat_id, "Finance Bot Ready.", main_menu())
 
-                self.send_response(200)
-                self.end_headers()
-                return
+user_states = make_state_store()
 
 
-            # ================= INCOME =================
+# ================= SHEETS =================
 
-            if text == "Income":
+_credentials = None
+_credentials_lock = threading.Lock()
+_service_local = threading.local()
 
-                accounts = get_accounts()
 
-                if not accounts:
+def get_credentials():
 
-                    send(chat_id, "No accounts found. Add account first.", main_menu())
+    global _credentials
 
-                    self.send_response(200)
-                    self.end_headers()
-                    return
+    with _credentials_lock:
 
-                user_states[chat_id] = {
-                    "flow": "income",
-                    "step": "account",
-                    "data": {}
-                }
+        if _credentials is None:
 
-                send(chat_id, "Select account:", keyboard_3col(accounts))
+            if not GOOGLE_CREDENTIALS:
+                raise ValueError("GOOGLE_CREDENTIALS environment variable not set")
 
-                self.send_response(200)
-                self.end_headers()
-                return
+            credentials_info = json.loads(GOOGLE_CREDENTIALS)
 
+            _credentials = service_account.Credentials.from_service_account_info(
+                credentials_info,
+                scopes=["https://www.googleapis.com/auth/spreadsheets"]
+            )
 
-            if state and state.get("flow") == "income":
+        # refresh once here under the lock so concurrent threads don't all
+        # hit the token endpoint when the access token expires
 
-                if state["step"] == "account":
+        if not _credentials.valid:
+            _credentials.refresh(GoogleAuthRequest())
 
-                    if not account_exists(text):
+        return _credentials
 
-                        send(chat_id, "Invalid account.")
 
-                        self.send_response(200)
-                        self.end_headers()
-                        return
+# calls made by the current thread, reset per update by process_update()
+_sheets_calls = threading.local()
 
-                    state["data"]["account"] = text
-                    state["step"] = "amount"
 
-                    send(chat_id, "Enter amount:")
+class TimedHttpRequest(HttpRequest):
 
-                    self.send_response(200)
-                    self.end_headers()
-                    return
+    # every Sheets API call executes through here
 
+    def execute(self, *args, **kwargs):
 
-                if state["step"] == "amount":
+        method = (self.methodId or "").replace("sheets.spreadsheets.", "")
 
-                    amount = parse_amount(text)
+        _sheets_calls.count = getattr(_sheets_calls, "count", 0) + 1
 
-                    if not amount:
+        with span("sheets_call_seconds", method=method):
+            return super().execute(*args, **kwargs)
 
-                        send(chat_id, "Invalid amount.")
 
-                        self.send_response(200)
-                        self.end_headers()
-                        return
+def get_service():
 
-                    state["data"]["amount"] = amount
-                    state["step"] = "note"
+    # httplib2 is not thread-safe, so each thread keeps its own client;
+    # credentials are shared and discovery comes from the bundled document
 
-                    send(chat_id, "Enter note (or type skip):")
+    credentials = get_credentials()
 
-                    self.send_response(200)
-                    self.end_headers()
-                    return
+    service = getattr(_service_local, "service", None)
 
+    if service is None:
 
-                if state["step"] == "note":
+        service = build(
+            "sheets",
+            "v4",
+            credentials=credentials,
+            static_discovery=True,
+            cache_discovery=False,
+            requestBuilder=TimedHttpRequest
+        )
 
-                    note = "" if text.lower() == "skip" else text
+        _service_local.service = service
 
-                    d = state["data"]
+    return service
 
-                    add_transaction(
-                        "Income",
-                        d["amount"],
-                        "",
-                        d["account"],
-                        note
-                    )
 
-                    send(chat_id, "Income recorded.", main_menu())
+def get_sheet(range_name):
+    service = get_service()
 
-                    user_states.pop(chat_id)
+    result = service.spreadsheets().values().get(
+        spreadsheetId=SHEET_ID,
+        range=range_name
+    ).execute()
 
-                    self.send_response(200)
-                    self.end_headers()
-                    return
+    return result.get("values", [])
 
 
-            # ================= EXPENSE =================
+def get_sheets(range_names):
 
-            if text == "Expense":
+    # resolve several ranges in one values.batchGet round trip;
+    # returns {range_name: rows} in the same shape get_sheet() does
 
-                accounts = get_accounts()
+    range_names = list(dict.fromkeys(range_names))
 
-                if not accounts:
+    if not range_names:
+        return {}
 
-                    send(chat_id, "No accounts found. Add account first.", main_menu())
+    if len(range_names) == 1:
+        return {range_names[0]: get_sheet(range_names[0])}
 
-                    self.send_response(200)
-                    self.end_headers()
-                    return
+    service = get_service()
 
-                user_states[chat_id] = {
-                    "flow": "expense",
-                    "step": "account",
-                    "data": {}
-                }
+    result = service.spreadsheets().values().batchGet(
+        spreadsheetId=SHEET_ID,
+        ranges=range_names
+    ).execute()
 
-                send(chat_id, "Select account:", keyboard_3col(accounts))
+    value_ranges = result.get("valueRanges", [])
 
-                self.send_response(200)
-                self.end_headers()
-                return
+    return {
+        name: vr.get("values", [])
+        for name, vr in zip(range_names, value_ranges)
+    }
 
 
-            if state and state.get("flow") == "expense":
+_sheet_ids = {}
 
-                if state["step"] == "account":
 
-                    if not account_exists(text):
+def sheet_id(title):
 
-                        send(chat_id, "Invalid account.")
+    # numeric tab id for batchUpdate requests; tab ids never change, so
+    # one spreadsheets.get is enough per process
 
-                        self.send_response(200)
-                        self.end_headers()
-                        return
+    if title not in _sheet_ids:
 
-                    state["data"]["account"] = text
-                    state["step"] = "amount"
+        meta = get_service().spreadsheets().get(
+            spreadsheetId=SHEET_ID,
+            fields="sheets.properties(sheetId,title)"
+        ).execute()
 
-                    send(chat_id, "Enter amount:")
+        for sheet in meta.get("sheets", []):
+            _sheet_ids[sheet["properties"]["title"]] = sheet["properties"]["sheetId"]
 
-                    self.send_response(200)
-                    self.end_headers()
-                    return
+    return _sheet_ids[title]
 
 
-                if state["step"] == "amount":
+# ================= LIST CACHE =================
 
-                    amount = parse_amount(text)
+# Accounts and Categories are tiny and read on almost every message, so keep
+# them in memory for LIST_CACHE_TTL seconds and drop them on every write
 
-                    if not amount:
+_list_cache = {}
+_list_cache_lock = threading.Lock()
 
-                        send(chat_id, "Invalid amount.")
 
-                        self.send_response(200)
-                        self.end_headers()
-                        return
+def get_list(range_name):
 
-                    balances, _ = calculate_account_balance()
+    with _list_cache_lock:
 
-                    if balances.get(state["data"]["account"], 0) < amount:
+        entry = _list_cache.get(range_name)
 
-                        send(chat_id, "Insufficient balance.", main_menu())
+        if entry and entry["expires"] > time.monotonic():
 
-                        user_states.pop(chat_id)
+            metric_inc("list_cache_requests_total", list=range_name, result="hit")
+            return entry
 
-                        self.send_response(200)
-                        self.end_headers()
-                        return
+    metric_inc("list_cache_requests_total", list=range_name, result="miss")
 
-                    state["data"]["amount"] = amount
-                    state["step"] = "category"
+    if LOCAL_STORE:
+        return fill_list(range_name, local_store().list_rows(range_name))
 
-                    cats = get_categories()
+    return fill_list(range_name, get_sheet(range_name))
 
-                    if cats:
-                        send(chat_id,"Select category or type new:",keyboard_category(cats))
-                    else:
-                        send(chat_id,"Enter category:")
 
-                    self.send_response(200)
-                    self.end_headers()
-                    return
+def fill_list(range_name, rows):
 
+    items = [r[0].strip() for r in rows[1:] if r and r[0].strip()]
 
-                if state["step"] == "category":
+    entry = {
+        "expires": time.monotonic() + LIST_CACHE_TTL,
+        "items": items,
+        "names": set(items),
+        "folded": {item.casefold(): item for item in items}
+    }
 
-                    category = text.strip()
+    with _list_cache_lock:
+        _list_cache[range_name] = entry
 
-                    if not category_exists(category):
-                        add_category(category)
+    return entry
 
-                    state["data"]["category"] = category
-                    state["step"] = "note"
 
-                    send(chat_id, "Enter note (or type skip):")
+def stale_lists(range_names):
 
-                    self.send_response(200)
-                    self.end_headers()
-                    return
+    now = time.monotonic()
 
+    with _list_cache_lock:
 
-                if state["step"] == "note":
+        return [
+            name for name in range_names
+            if name not in _list_cache or _list_cache[name]["expires"] <= now
+        ]
 
-                    note = "" if text.lower() == "skip" else text
 
-                    d = state["data"]
+def invalidate_list(range_name):
 
-                    add_transaction(
-                        "Expense",
-                        d["amount"],
-                        d["category"],
-                        d["account"],
-                        note
-                    )
+    with _list_cache_lock:
+        _list_cache.pop(range_name, None)
 
-                    send(chat_id, "Expense recorded.", main_menu())
 
-                    user_states.pop(chat_id)
+# lists whose names compare case-insensitively
+FOLDED_LISTS = {"Categories!A:A"}
 
-                    self.send_response(200)
-                    self.end_headers()
-                    return
-                                # ================= TRANSFER =================
 
-            if text == "Transfer":
+def delete_list_rows(range_name, rows, name):
 
-                accounts = get_accounts()
+    # drops just the matching rows of a list tab (rows as read from
+    # range_name, header first) in one batchUpdate, bottom up so the
+    # indices stay valid; the rest of the list is never rewritten
 
-                if not accounts:
+    if range_name in FOLDED_LISTS:
+        matches = lambda value: value.casefold() == name.casefold()
+    else:
+        matches = lambda value: value == name
 
-                    send(chat_id, "No accounts found.", main_menu())
+    indices = [i for i, row in enumerate(rows) if i and row and matches(row[0].strip())]
 
-                    self.send_response(200)
-                    self.end_headers()
-                    return
+    if not indices:
+        return
 
-                user_states[chat_id] = {
-                    "flow": "transfer",
-                    "step": "from",
-                    "data": {}
-                }
+    tab = sheet_id(range_name.split("!")[0])
 
-                send(chat_id, "Transfer from:", keyboard_3col(accounts))
+    get_service().spreadsheets().batchUpdate(
+        spreadsheetId=SHEET_ID,
+        body={"requests": [
+            {"deleteDimension": {"range": {
+                "sheetId": tab,
+                "dimension": "ROWS",
+                "startIndex": i,
+                "endIndex": i + 1
+            }}}
+            for i in reversed(indices)
+        ]}
+    ).execute()
 
-                self.send_response(200)
-                self.end_headers()
-                return
 
+# ================= LOCAL STORE =================
 
-            if state and state.get("flow") == "transfer":
+# With LOCAL_STORE set, writes land in a local SQLite journal first and reads
+# are answered from local tables; a background syncer replays the journal to
+# Sheets in batched appends, so the sheet becomes a replica of the database.
+# Run the syncer (LOCAL_SYNC=1) in only one process per database file.
 
-                if state["step"] == "from":
+LOCAL_SCHEMA = """
+CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+CREATE TABLE IF NOT EXISTS transactions (
+    id INTEGER PRIMARY KEY,
+    ts TEXT, type TEXT, kind TEXT, amount INTEGER,
+    category TEXT, account TEXT, note TEXT
+);
+CREATE INDEX IF NOT EXISTS transactions_account ON transactions (account);
+CREATE INDEX IF NOT EXISTS transactions_category ON transactions (category COLLATE NOCASE);
+CREATE INDEX IF NOT EXISTS transactions_kind ON transactions (kind, category, amount);
+CREATE INDEX IF NOT EXISTS transactions_kind_ts ON transactions (kind, ts);
+CREATE TABLE IF NOT EXISTS balances (account TEXT PRIMARY KEY, amount INTEGER NOT NULL);
+CREATE TABLE IF NOT EXISTS rollup (
+    month TEXT, kind TEXT, account TEXT, category TEXT,
+    amount INTEGER NOT NULL, count INTEGER NOT NULL,
+    PRIMARY KEY (month, kind, account, category)
+);
+CREATE TABLE IF NOT EXISTS accounts (id INTEGER PRIMARY KEY, name TEXT UNIQUE);
+CREATE TABLE IF NOT EXISTS categories (id INTEGER PRIMARY KEY, name TEXT UNIQUE COLLATE NOCASE);
+CREATE TABLE IF NOT EXISTS journal (id INTEGER PRIMARY KEY, op TEXT, range TEXT, rows TEXT);
+"""
 
-                    if not account_exists(text):
+# list range -> (local table, how the usage check compares transactions)
+LOCAL_LISTS = {
+    "Accounts!A:A": ("accounts", "account = ?"),
+    "Categories!A:A": ("categories", "category = ? COLLATE NOCASE")
+}
 
-                        send(chat_id, "Invalid account.")
 
-                        self.send_response(200)
-                        self.end_headers()
-                        return
+class LocalStore:
 
-                    state["data"]["from"] = text
-                    state["step"] = "to"
+    def __init__(self, path):
 
-                    send(chat_id, "Transfer to:", keyboard_3col(get_accounts()))
+        self.lock = threading.Lock()
+        self.syncing = threading.Lock()
+        self.wake = threading.Event()
 
-                    self.send_response(200)
-                    self.end_headers()
-                    return
+        self.db = sqlite3.connect(path, timeout=10, check_same_thread=False, isolation_level=None)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=FULL")
+        self.db.executescript(LOCAL_SCHEMA)
 
+        # databases created before the rollup table existed
+        if not self.db.execute("SELECT 1 FROM rollup LIMIT 1").fetchone():
+            self.rebuild_rollup()
 
-                if state["step"] == "to":
+    @contextmanager
+    def transaction(self):
 
-                    if not account_exists(text) or text == state["data"]["from"]:
+        # BEGIN IMMEDIATE .. COMMIT under self.lock; on any error it rolls
+        # back, so the shared connection is never left inside a transaction
 
-                        send(chat_id, "Invalid destination.")
+        with self.lock:
 
-                        self.send_response(200)
-                        self.end_headers()
-                        return
+            self.db.execute("BEGIN IMMEDIATE")
 
-                    state["data"]["to"] = text
-                    state["step"] = "amount"
+            try:
 
-                    send(chat_id, "Enter amount:")
+                yield
+                self.db.execute("COMMIT")
 
-                    self.send_response(200)
-                    self.end_headers()
-                    return
+            except BaseException:
 
+                if self.db.in_transaction:
+                    self.db.execute("ROLLBACK")
 
-                if state["step"] == "amount":
+                raise
 
-                    amount = parse_amount(text)
+    def seeded(self):
 
-                    if not amount:
+        return self.db.execute("SELECT 1 FROM meta WHERE key = 'seeded'").fetchone() is not None
 
-                        send(chat_id, "Invalid amount.")
+    # ----- seeding -----
 
-                        self.send_response(200)
-                        self.end_headers()
-                        return
+    def seed(self):
 
-                    balances, _ = calculate_account_balance()
+        with self.lock:
 
-                    if balances.get(state["data"]["from"], 0) < amount:
+            if self.seeded():
+                return
 
-                        send(chat_id, "Insufficient balance.", main_menu())
+        results = get_sheets(["Sheet1!A:F", "Accounts!A:A", "Categories!A:A"])
 
-                        user_states.pop(chat_id)
+        transactions = []
 
-                        self.send_response(200)
-                        self.end_headers()
-                        return
+        # rows without an account or a usable amount are kept with a NULL
+        # amount: they count toward nothing, but like in Sheets mode they
+        # still keep their account and category from being deleted
 
-                    add_transaction(
-                        "Transfer-Out",
-                        amount,
-                        "Transfer",
-                        state["data"]["from"],
-                        f"To {state['data']['to']}"
-                    )
+        for row in results["Sheet1!A:F"][1:]:
 
-                    add_transaction(
-                        "Transfer-In",
-                        amount,
-                        "Transfer",
-                        state["data"]["to"],
-                        f"From {state['data']['from']}"
-                    )
+            if len(row) < 4:
+                continue
 
-                    send(chat_id, "Transfer completed.", main_menu())
+            try:
+                amount = int(float(row[2])) if len(row) >= 5 else None
+            except:
+                amount = None
 
-                    user_states.pop(chat_id)
+            row = row + [""] * (6 - len(row))
 
-                    self.send_response(200)
-                    self.end_headers()
-                    return
+            transactions.append((row[0], row[1].strip(), amount, row[3].strip(), row[4].strip(), row[5]))
 
+        with self.transaction():
 
-            # ================= BALANCE =================
+            # another process may have seeded while we read the sheet
+            if self.seeded():
+                return
 
-            if text == "Balance":
+            self.insert_transactions(transactions)
 
-                balances, total = calculate_account_balance()
+            for range_name, (table, _) in LOCAL_LISTS.items():
 
-                msg = ""
+                self.db.executemany(
+                    f"INSERT OR IGNORE INTO {table} (name) VALUES (?)",
+                    [(r[0].strip(),) for r in results[range_name][1:] if r and r[0].strip()]
+                )
 
-                for acc, bal in sorted(balances.items(), key=lambda x: x[1], reverse=True):
+            self.db.execute("INSERT INTO meta VALUES ('seeded', ?)", (now_wib().isoformat(),))
 
-                    msg += f"{acc}: {format_currency(bal)}\n"
+    # ----- writes (caller is inside self.transaction()) -----
 
-                msg += "\nTOTAL: " + format_currency(total)
+    def insert_transactions(self, rows):
 
-                send(chat_id, msg, main_menu())
+        # rows: (timestamp, type, amount, category, account, note); only
+        # rows with an amount reach the balances and the rollup
 
-                self.send_response(200)
-                self.end_headers()
-                return
+        self.db.executemany(
+            "INSERT INTO transactions (ts, type, kind, amount, category, account, note) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?)",
+            [(ts, t, t.strip().lower(), a, c, acc, n) for ts, t, a, c, acc, n in rows]
+        )
 
+        rows = [row for row in rows if row[2] is not None]
 
-            # ================= MANAGEMENT =================
+        deltas = {}
 
-            if text == "Management":
+        for _, type_tx, amount, _, account, _ in rows:
+            ledger_apply(deltas, type_tx, amount, account)
 
-                send(chat_id,"Management:",[["Accounts","Categories"],["Back"]])
+        self.db.executemany(
+            "INSERT INTO balances VALUES (?, ?) "
+            "ON CONFLICT (account) DO UPDATE SET amount = amount + excluded.amount",
+            deltas.items()
+        )
 
-                self.send_response(200)
-                self.end_headers()
-                return
+        self.db.executemany(
+            "INSERT INTO rollup VALUES (?, ?, ?, ?, ?, 1) "
+            "ON CONFLICT (month, kind, account, category) "
+            "DO UPDATE SET amount = amount + excluded.amount, count = count + 1",
+            [(local_month(ts), t.strip().lower(), acc, c, a) for ts, t, a, c, acc, _ in rows]
+        )
 
+    def journal(self, op, range_name, rows):
 
-            # ===== ACCOUNT MANAGEMENT =====
+        self.db.execute(
+            "INSERT INTO journal (op, range, rows) VALUES (?, ?, ?)",
+            (op, range_name, json.dumps(rows, separators=(",", ":")))
+        )
 
-            if text == "Accounts":
+    def record_transactions(self, rows):
 
-                send(chat_id,"Account Management:",[["List","Add"],["Delete","Back"]])
+        with self.transaction():
 
-                self.send_response(200)
-                self.end_headers()
-                return
+            self.insert_transactions(rows)
+            self.journal("append", "Sheet1!A:F", [list(r) for r in rows])
 
+        self.wake.set()
 
-            if text == "List":
+    def clear_transactions(self, archive=None):
 
-                balances, _ = calculate_account_balance()
+        # with an archive tab name the syncer archives Sheet1 to that tab
+        # once earlier appends are out; the archive lives only in Sheets
 
-                msg = ""
+        with self.transaction():
 
-                for acc in get_accounts():
+            if archive:
+                self.journal("archive", archive, [])
 
-                    msg += f"{acc}: {format_currency(balances.get(acc,0))}\n"
+            else:
+                self.journal("clear", "Sheet1!A2:Z", [])
 
-                send(chat_id, msg, main_menu())
+            self.db.execute("DELETE FROM transactions")
+            self.db.execute("DELETE FROM balances")
+            self.db.execute("DELETE FROM rollup")
 
-                self.send_response(200)
-                self.end_headers()
-                return
+        self.wake.set()
 
+    def add_name(self, range_name, name):
 
-            if text == "Add":
+        table, _ = LOCAL_LISTS[range_name]
 
-                user_states[chat_id] = {"flow": "add_account"}
+        with self.transaction():
 
-                send(chat_id, "Enter new account name:")
+            self.db.execute(f"INSERT OR IGNORE INTO {table} (name) VALUES (?)", (name,))
+            self.journal("append", range_name, [[name]])
 
-                self.send_response(200)
-                self.end_headers()
-                return
+        self.wake.set()
 
+    def delete_name(self, range_name, name):
 
-            if state and state.get("flow") == "add_account":
+        table, usage = LOCAL_LISTS[range_name]
 
-                if account_exists(text):
+        # the usage check is inside the write transaction, so another
+        # process cannot record a transaction for name in between
+        with self.transaction():
 
-                    send(chat_id, "Account already exists.", main_menu())
+            if self.db.execute(f"SELECT 1 FROM transactions WHERE {usage} LIMIT 1", (name,)).fetchone():
+                return False
 
-                else:
+            self.db.execute(f"DELETE FROM {table} WHERE name = ?", (name,))
+            self.journal("delete", range_name, [[name]])
 
-                    add_account(text)
+        self.wake.set()
 
-                    send(chat_id, "Account added.", main_menu())
+        return True
 
-                user_states.pop(chat_id)
+    # ----- reads -----
 
-                self.send_response(200)
-                self.end_headers()
-                return
+    def list_rows(self, range_name):
 
+        # shaped like get_sheet() output, header row included
 
-            if text == "Delete":
+        table, _ = LOCAL_LISTS[range_name]
 
-                user_states[chat_id] = {"flow": "delete_account"}
+        with self.lock:
+            names = self.db.execute(f"SELECT name FROM {table} ORDER BY id").fetchall()
 
-                send(chat_id, "Enter account name to delete:")
+        return [[""]] + [[name] for (name,) in names]
 
-                self.send_response(200)
-                self.end_headers()
-                return
+    def balances(self):
 
+        with self.lock:
+            return dict(self.db.execute("SELECT account, amount FROM balances").fetchall())
 
-            if state and state.get("flow") == "delete_account":
+    def rebuild_rollup(self):
 
-                if not account_exists(text):
+        with self.transaction():
 
-                    send(chat_id, "Account not found.", main_menu())
+            self.db.execute("DELETE FROM rollup")
+            self.db.execute(
+                "INSERT INTO rollup "
+                "SELECT CASE WHEN ts GLOB '[0-9][0-9][0-9][0-9]-[0-9][0-9]*' THEN substr(ts, 1, 7) ELSE '' END, "
+                "kind, account, category, SUM(amount), COUNT(*) "
+                "FROM transactions WHERE amount IS NOT NULL GROUP BY 1, 2, 3, 4"
+            )
 
-                elif not delete_account(text):
+            return self.db.execute("SELECT COUNT(*) FROM rollup").fetchone()[0]
 
-                    send(chat_id, "Account has transactions. Cannot delete.", main_menu())
+    def expense_totals(self, start=None, end=None):
 
-                else:
+        # all-time and whole-month ranges come from the rollup; otherwise
+        # ts is stored as "YYYY-MM-DD HH:MM:SS" WIB, which sorts as text
 
-                    send(chat_id, "Account deleted.", main_menu())
+        if start is None:
 
-                user_states.pop(chat_id)
+            with self.lock:
 
-                self.send_response(200)
-                self.end_headers()
-                return
+                return self.db.execute(
+                    "SELECT category, SUM(amount) FROM rollup "
+                    "WHERE kind = 'expense' GROUP BY category"
+                ).fetchall()
 
+        if is_month_start(start) and is_month_start(end):
 
-            # ===== CATEGORY MANAGEMENT =====
+            with self.lock:
 
-            if text == "Categories":
+                return self.db.execute(
+                    "SELECT category, SUM(amount) FROM rollup "
+                    "WHERE kind = 'expense' AND month != '' AND month >= ? AND month < ? "
+                    "GROUP BY category",
+                    (f"{start.astimezone(WIB):%Y-%m}", f"{end.astimezone(WIB):%Y-%m}")
+                ).fetchall()
 
-                send(chat_id,"Category Management:",[["CatList","CatAdd"],["CatDelete","Back"]])
+        with self.lock:
 
-                self.send_response(200)
-                self.end_headers()
-                return
+            return self.db.execute(
+                "SELECT category, SUM(amount) FROM transactions "
+                "WHERE kind = 'expense' AND amount IS NOT NULL AND ts >= ? AND ts < ? "
+                "GROUP BY category",
+                (
+                    start.astimezone(WIB).strftime("%Y-%m-%d %H:%M:%S"),
+                    end.astimezone(WIB).strftime("%Y-%m-%d %H:%M:%S")
+                )
+            ).fetchall()
 
+    def export_rows(self, start=None, end=None):
 
-            if text == "CatList":
+        # header plus transactions in insertion order, fetched in pages
 
-                cats = get_categories()
+        yield ["Date", "Type", "Amount", "Category", "Account", "Note"]
 
-                if not cats:
+        where, args = "", ()
 
-                    send(chat_id,"No categories.",main_menu())
+        if start is not None:
 
-                else:
+            where = " AND ts >= ? AND ts < ?"
+            args = (
+                start.astimezone(WIB).strftime("%Y-%m-%d %H:%M:%S"),
+                end.astimezone(WIB).strftime("%Y-%m-%d %H:%M:%S")
+            )
 
-                    msg = "Categories:\n\n"
+        last = 0
 
-                    for i,c in enumerate(cats,start=1):
+        while True:
 
-                        msg += f"{i}. {c}\n"
+            with self.lock:
 
-                    send(chat_id,msg,main_menu())
+                rows = self.db.execute(
+                    "SELECT id, ts, type, amount, category, account, note FROM transactions "
+                    "WHERE id > ?" + where + " ORDER BY id LIMIT ?",
+                    (last,) + args + (EXPORT_PAGE_ROWS,)
+                ).fetchall()
 
-                self.send_response(200)
-                self.end_headers()
+            if not rows:
                 return
 
+            for row in rows:
+                yield list(row[1:])
 
-            if text == "CatAdd":
+            last = rows[-1][0]
 
-                user_states[chat_id]={"flow":"add_category"}
+    # ----- sync -----
 
-                send(chat_id,"Enter category name:")
+    def sync_once(self):
 
-                self.send_response(200)
-                self.end_headers()
-                return
+        # replays the oldest journal entry, merging the run of appends to
+        # the same range behind it into one request; returns entries done
 
+        # entries are read, sent and deleted under self.syncing, so a
+        # second caller in this process cannot send the same entries again
+        with self.syncing:
 
-            if state and state.get("flow")=="add_category":
+            with self.lock:
 
-                if category_exists(text):
+                entries = self.db.execute(
+                    "SELECT id, op, range, rows FROM journal ORDER BY id LIMIT ?",
+                    (SYNC_BATCH,)
+                ).fetchall()
 
-                    send(chat_id,"Category already exists.",main_menu())
+            if not entries:
+                return 0
 
-                else:
+            _, op, range_name, _ = entries[0]
 
-                    add_category(text)
+            batch = [entries[0]]
 
-                    send(chat_id,"Category added.",main_menu())
+            if op == "append":
 
-                user_states.pop(chat_id)
+                for entry in entries[1:]:
 
-                self.send_response(200)
-                self.end_headers()
-                return
+                    if entry[1:3] != (op, range_name):
+                        break
 
+                    batch.append(entry)
 
-            if text == "CatDelete":
+            values = [row for entry in batch for row in json.loads(entry[3])]
 
-                user_states[chat_id]={"flow":"delete_category"}
+            values_api = get_service().spreadsheets().values()
 
-                send(chat_id,"Enter category to delete:")
+            if op == "append":
 
-                self.send_response(200)
-                self.end_headers()
-                return
+                values_api.append(
+                    spreadsheetId=SHEET_ID,
+                    range=range_name,
+                    valueInputOption="RAW",
+                    body={"values": values}
+                ).execute()
 
+            elif op == "clear":
 
-            if state and state.get("flow")=="delete_category":
+                values_api.clear(spreadsheetId=SHEET_ID, range=range_name).execute()
 
-                if not category_exists(text):
+            elif op == "archive":
 
-                    send(chat_id,"Category not found.",main_menu())
+                archive_sheet1(range_name)
 
-                elif not delete_category(text):
+            elif op == "delete":
 
-                    send(chat_id,"Category used in transactions.",main_menu())
+                rows = get_sheet(range_name)
 
+                for (name,) in values:
+                    delete_list_rows(range_name, rows, name)
+
+            with self.lock:
+                self.db.execute("DELETE FROM journal WHERE id <= ?", (batch[-1][0],))
+
+            metric_inc("local_sync_entries_total", len(batch))
+
+            return len(batch)
+
+    def sync_forever(self):
+
+        delay = 1
+
+        while True:
+
+            try:
+
+                self.wake.clear()
+
+                while self.sync_once():
+                    pass
+
+                delay = 1
+
+                self.wake.wait(SYNC_INTERVAL)
+
+            except Exception as e:
+
+                print("SYNC ERROR:", e)
+                metric_inc("local_sync_errors_total")
+
+                time.sleep(delay)
+                delay = min(delay * 2, 60)
+
+    def pending(self):
+
+        with self.lock:
+            return self.db.execute("SELECT COUNT(*) FROM journal").fetchone()[0]
+
+
+def local_month(ts):
+
+    return ts[:7] if re.match(r"\d{4}-\d\d", ts or "") else ""
+
+
+_local_store = None
+_local_store_lock = threading.Lock()
+
+
+def local_store(background=True):
+
+    # background=False builds the store without the syncer thread, for a
+    # caller that drains the journal itself; only the first call decides
+
+    global _local_store
+
+    with _local_store_lock:
+
+        if _local_store is None:
+
+            store = LocalStore(LOCAL_STORE)
+            store.seed()
+
+            if LOCAL_SYNC and background:
+                threading.Thread(target=store.sync_forever, daemon=True).start()
+
+            _local_store = store
+
+        return _local_store
+
+
+# ================= ACCOUNT =================
+
+def get_accounts():
+    return list(get_list("Accounts!A:A")["items"])
+
+
+def account_exists(name):
+    return name in get_list("Accounts!A:A")["names"]
+
+
+def add_account(name):
+
+    if LOCAL_STORE:
+
+        local_store().add_name("Accounts!A:A", name)
+        invalidate_list("Accounts!A:A")
+        return
+
+    service = get_service()
+
+    service.spreadsheets().values().append(
+        spreadsheetId=SHEET_ID,
+        range="Accounts!A:A",
+        valueInputOption="RAW",
+        body={"values": [[name]]}
+    ).execute()
+
+    invalidate_list("Accounts!A:A")
+
+
+def delete_account(name):
+
+    if LOCAL_STORE:
+
+        deleted = local_store().delete_name("Accounts!A:A", name)
+        invalidate_list("Accounts!A:A")
+        return deleted
+
+    with _tx_lock:
+
+        # deletes run under the lock so two of them never shift each
+        # other's row numbers
+        results = tx_sync(["Accounts!A:A"])
+
+        if rollup_uses(2, name):
+            return False
+
+        delete_list_rows("Accounts!A:A", results["Accounts!A:A"], name)
+
+    invalidate_list("Accounts!A:A")
+
+    return True
+
+
+# ================= CATEGORY =================
+
+def get_categories():
+
+    return list(get_list("Categories!A:A")["items"])
+
+
+def category_exists(name):
+
+    return name.casefold() in get_list("Categories!A:A")["folded"]
+
+
+def add_category(name):
+
+    if LOCAL_STORE:
+
+        local_store().add_name("Categories!A:A", name)
+        invalidate_list("Categories!A:A")
+        return
+
+    service = get_service()
+
+    service.spreadsheets().values().append(
+        spreadsheetId=SHEET_ID,
+        range="Categories!A:A",
+        valueInputOption="RAW",
+        body={"values": [[name]]}
+    ).execute()
+
+    invalidate_list("Categories!A:A")
+
+
+def delete_category(name):
+
+    if LOCAL_STORE:
+
+        deleted = local_store().delete_name("Categories!A:A", name)
+        invalidate_list("Categories!A:A")
+        return deleted
+
+    with _tx_lock:
+
+        # deletes run under the lock so two of them never shift each
+        # other's row numbers
+        results = tx_sync(["Categories!A:A"])
+
+        if rollup_uses(3, name):
+            return False
+
+        delete_list_rows("Categories!A:A", results["Categories!A:A"], name)
+
+    invalidate_list("Categories!A:A")
+
+    return True
+
+
+# ================= TRANSACTION TABLE =================
+
+# Parsed Sheet1 rows, column by column: amounts and timestamps in typed
+# arrays, type/category/account as integer codes into one interned string
+# list. Rows that the old per-row parsing skipped (short rows, bad amounts)
+# are skipped here too.
+
+class TransactionTable:
+
+    def __init__(self):
+
+        self.amounts = array("q")
+        self.timestamps = array("d")
+        self.types = array("I")
+        self.categories = array("I")
+        self.accounts = array("I")
+
+        self.strings = []
+        self.codes = {}
+
+        # row indices sorted by timestamp, and those timestamps; appends in
+        # time order extend it in place, anything else forces a rebuild
+        self.time_order = array("I")
+        self.time_keys = array("d")
+        self.time_sorted = True
+
+    def __len__(self):
+
+        return len(self.amounts)
+
+    def intern(self, text):
+
+        code = self.codes.get(text)
+
+        if code is None:
+
+            code = len(self.strings)
+
+            self.codes[text] = code
+            self.strings.append(text)
+
+        return code
+
+    def extend(self, rows):
+
+        # returns the rows it could not take (short, or amount not a number)
+
+        skipped = []
+
+        for row in rows:
+
+            if len(row) < 5:
+                skipped.append(row)
+                continue
+
+            try:
+                amount = int(float(row[2]))
+            except:
+                skipped.append(row)
+                continue
+
+            timestamp = parse_timestamp(row[0])
+
+            if timestamp == timestamp and self.time_sorted:
+
+                if self.time_keys and timestamp < self.time_keys[-1]:
+                    self.time_sorted = False
                 else:
+                    self.time_order.append(len(self.amounts))
+                    self.time_keys.append(timestamp)
+
+            self.amounts.append(amount)
+            self.timestamps.append(timestamp)
+            self.types.append(self.intern(row[1].strip().lower()))
+            self.categories.append(self.intern(row[3].strip()))
+            self.accounts.append(self.intern(row[4].strip()))
+
+        return skipped
+
+    def time_index(self):
+
+        if not self.time_sorted:
+
+            timestamps = self.timestamps
+
+            order = sorted(
+                (i for i in range(len(self)) if timestamps[i] == timestamps[i]),
+                key=timestamps.__getitem__
+            )
+
+            self.time_order = array("I", order)
+            self.time_keys = array("d", (timestamps[i] for i in order))
+            self.time_sorted = True
+
+        return self.time_keys, self.time_order
+
+    def rows_between(self, start, end):
+
+        # indices of rows with start <= timestamp < end (epoch seconds)
+
+        keys, order = self.time_index()
+
+        return order[bisect_left(keys, start):bisect_left(keys, end)]
+
+    def expense_totals(self, indices=None):
+
+        # {category: amount} over the given rows (default: all of them)
+
+        expense = self.codes.get("expense")
+
+        totals = {}
+
+        if expense is None:
+            return totals
+
+        if indices is None:
+            indices = range(len(self))
+
+        types = self.types
+        categories = self.categories
+        amounts = self.amounts
+
+        for i in indices:
+
+            if types[i] == expense:
+
+                category = categories[i]
+                totals[category] = totals.get(category, 0) + amounts[i]
+
+        return {self.strings[code]: amount for code, amount in totals.items()}
+
+
+def parse_timestamp(text):
+
+    # Sheet1 timestamps are written by now_wib(); NaN when unparseable.
+    # Times without an offset are WIB, ones with an offset keep it
+
+    try:
+        moment = datetime.fromisoformat(text.strip())
+    except (ValueError, AttributeError):
+        return float("nan")
+
+    if moment.tzinfo is None:
+        moment = moment.replace(tzinfo=WIB)
+
+    return moment.timestamp()
+
+
+# ================= SHEET1 SYNC =================
+
+# Sheet1 is append-only in normal use, so keep a mirror of it and after the
+# first full read only fetch rows past the last one seen. A small window of
+# trailing rows is re-read alongside the delta; if it no longer matches what
+# we hold, rows were edited or removed out-of-band and we resync in full.
+#
+# The mirror has two levels: the monthly rollup and ledger are always kept,
+# the per-row table only once something needs it (see tx_table()). A cold
+# start seeds the rollup from the Rollup tab plus the rows added since.
+
+SYNC_TAIL_ROWS = 5
+
+# n: rows in Sheet1 as the values API counts them, header and blanks included
+
+_tx = {
+    "n": None,
+    "tail": [],
+    "table": None
+}
+_tx_lock = threading.Lock()
+
+
+def tx_window(n, also_ranges):
+
+    # reads the SYNC_TAIL_ROWS rows we hold plus everything after them as
+    # one range -> (tail, delta, results). The range starts at or before
+    # row n: appends only grow the grid to the last row written, and a
+    # range starting past the grid is a 400 from the values API. None
+    # when even that is past the grid, i.e. rows were deleted.
+
+    window_range = f"Sheet1!A{max(1, n - SYNC_TAIL_ROWS + 1)}:F"
+
+    try:
+        results = get_sheets([window_range] + also_ranges)
+    except HttpError as e:
+
+        if e.resp.status != 400:
+            raise
+
+        return None
+
+    rows = results[window_range]
+    held = min(n, SYNC_TAIL_ROWS)
+
+    return rows[:held], rows[held:], results
+
+
+def tx_load(rows):
+
+    table = TransactionTable()
+    skipped = table.extend(rows[1:])
+
+    _tx["n"] = len(rows)
+    _tx["tail"] = rows[-SYNC_TAIL_ROWS:]
+    _tx["table"] = table
+
+    rollup_seed({})
+    rollup_extend(table, 0)
+    rollup_unparsed(skipped)
+
+    metric_inc("sheet1_full_syncs_total")
+
+
+def tx_extend(rows):
+
+    # without the per-row table, parse into a throwaway one just to
+    # feed the rollup
+
+    table = _tx["table"] if _tx["table"] is not None else TransactionTable()
+    start = len(table)
+
+    # an empty sheet's first row is its header
+    skipped = table.extend(rows[1:] if _tx["n"] == 0 else rows)
+
+    _tx["n"] += len(rows)
+    _tx["tail"] = (_tx["tail"] + rows)[-SYNC_TAIL_ROWS:]
+
+    rollup_extend(table, start)
+    rollup_unparsed(skipped)
+
+
+def tx_sync(also_ranges=()):
+
+    # brings the mirror up to date (caller holds _tx_lock); any extra
+    # ranges ride along in the same batchGet and are returned
+
+    also_ranges = list(also_ranges)
+
+    if _tx["n"] is None:
+
+        results = rollup_restore(also_ranges)
+
+        if results is not None:
+            return results
+
+        results = get_sheets(["Sheet1!A:F"] + also_ranges)
+        tx_load(results["Sheet1!A:F"])
+
+        return results
+
+    window = tx_window(_tx["n"], also_ranges)
+
+    if window is None:
+
+        results = get_sheets(["Sheet1!A:F"] + also_ranges)
+        tx_load(results["Sheet1!A:F"])
+
+        return results
+
+    tail, delta, results = window
+
+    if tail != _tx["tail"]:
+
+        tx_load(get_sheet("Sheet1!A:F"))
+        return results
+
+    if delta:
+        tx_extend(delta)
+
+    rollup_maybe_persist()
+
+    return results
+
+
+def tx_table():
+
+    # the per-row table, loading Sheet1 in full the first time it is
+    # needed after a cold start from the Rollup tab (caller holds _tx_lock)
+
+    tx_sync()
+
+    if _tx["table"] is None:
+        tx_load(get_sheet("Sheet1!A:F"))
+
+    return _tx["table"]
+
+
+def tx_record(updated_range, values):
+
+    # our own append landed right after the mirror: extend it in place.
+    # Anything else is left for the next tx_sync() to pick up as a delta.
+
+    match = re.search(r"![A-Z]+(\d+)", updated_range or "")
+
+    with _tx_lock:
+
+        if _tx["n"] is None or not match:
+            return
+
+        if int(match.group(1)) != _tx["n"] + 1:
+            return
+
+        tx_extend([sheet_row(v) for v in values])
+
+
+@on_event("transactions_reset")
+def tx_reset():
+
+    # after QuickClean only the header is left, so the next sync's full
+    # read is a single row (the stale Rollup tab fails its tail check).
+    # The tab is rewritten once ROLLUP_PERSIST_ROWS rows have been added
+    # again, counted from the cleared sheet rather than the old row count
+
+    with _tx_lock:
+
+        _tx["n"] = None
+        _tx["tail"] = []
+        _tx["table"] = None
+
+        rollup_seed({})
+
+        _rollup["persisted_n"] = 0
+
+
+def sheet_row(values):
+
+    # what the values API will return for a row we wrote with RAW input
+
+    row = ["" if v is None else str(v) for v in values]
+
+    while row and row[-1] == "":
+        row.pop()
+
+    return row
+
+
+# ================= ROLLUP =================
+
+# Sums and counts per (month, type, account, category), month as "YYYY-MM"
+# in WIB ("" for unparseable dates). Balances, all-time and whole-month
+# spending and the in-use checks are answered from here. The Rollup tab
+# holds a copy; its header row also records how many Sheet1 rows it covers
+# and a checksum of their tail, so a cold start can trust it and only read
+# the rows after it.
+
+ROLLUP_HEADER = ["Month", "Type", "Account", "Category", "Amount", "Count"]
+
+# month of the entries counting rows that have no usable amount; they carry
+# no money but still keep their account and category from being deleted
+ROLLUP_UNPARSED = "?"
+
+# part of the checksum, so Rollup tabs written before a bucketing fix fail
+# their tail check and get rebuilt from Sheet1 (2: months by WIB day,
+# 3: rows without a usable amount)
+ROLLUP_VERSION = "3"
+
+_rollup = {
+    "sums": {},
+    "uses": ({}, {}),
+    "persisted_n": 0
+}
+
+
+def rollup_seed(sums):
+
+    # uses counts rows per account and per casefolded category, so the
+    # in-use checks are a dict lookup
+
+    accounts, categories = {}, {}
+
+    for (_, _, account, category), (_, count) in sums.items():
+
+        accounts[account] = accounts.get(account, 0) + count
+        folded = category.casefold()
+        categories[folded] = categories.get(folded, 0) + count
+
+    _rollup["sums"] = sums
+    _rollup["uses"] = (accounts, categories)
+
+    ledger_seed(sums)
+
+
+def rollup_extend(table, start):
+
+    sums = _rollup["sums"]
+    accounts, categories = _rollup["uses"]
+    strings = table.strings
+    months = {}
+
+    deltas = {}
+    added = {}
+
+    for i in range(start, len(table)):
+
+        # rows come in batches of a few dates, so cache per whole WIB day
+        # (a UTC day would straddle WIB midnight and the month boundary)
+        local = table.timestamps[i] + 7 * 3600
+        day = local // 86400 if local == local else None
+
+        month = months.get(day)
+
+        if month is None:
+
+            month = "" if day is None else time.strftime("%Y-%m", time.gmtime(local))
+            months[day] = month
+
+        key = (month, strings[table.types[i]], strings[table.accounts[i]], strings[table.categories[i]])
+
+        entry = sums.get(key)
+
+        if entry is None:
+            entry = sums[key] = [0, 0]
+
+        entry[0] += table.amounts[i]
+        entry[1] += 1
+
+        deltas[key] = deltas.get(key, 0) + table.amounts[i]
+        added[key] = added.get(key, 0) + 1
+
+    for (_, _, account, category), count in added.items():
+
+        accounts[account] = accounts.get(account, 0) + count
+        folded = category.casefold()
+        categories[folded] = categories.get(folded, 0) + count
+
+    ledger_extend(deltas)
+
+
+def rollup_unparsed(rows):
+
+    # rows the table skipped: an account is referenced by any row with 5
+    # columns, a category by any with 4, whatever the amount says
+
+    sums = _rollup["sums"]
+    accounts, categories = _rollup["uses"]
+
+    for row in rows:
+
+        if len(row) < 4:
+            continue
+
+        account = row[4].strip() if len(row) >= 5 else ""
+        category = row[3].strip()
+
+        entry = sums.setdefault((ROLLUP_UNPARSED, "", account, category), [0, 0])
+        entry[1] += 1
+
+        accounts[account] = accounts.get(account, 0) + 1
+        folded = category.casefold()
+        categories[folded] = categories.get(folded, 0) + 1
+
+
+def rollup_checksum(rows):
+
+    return str(zlib.crc32((ROLLUP_VERSION + json.dumps(rows, separators=(",", ":"))).encode()))
+
+
+def rollup_restore(also_ranges):
+
+    # cold start from the Rollup tab; returns the batch results, or None
+    # if there is no usable rollup and Sheet1 has to be read in full
+
+    try:
+        rows = get_sheet("Rollup!A:H")
+    except HttpError:
+        return None
+
+    if not rows or len(rows[0]) < 8:
+        return None
+
+    try:
+        n = int(rows[0][6])
+    except ValueError:
+        return None
+
+    sums = {}
+
+    for row in rows[1:]:
+
+        row = row + [""] * (6 - len(row))
+
+        try:
+            sums[tuple(row[:4])] = [int(row[4]), int(row[5])]
+        except ValueError:
+            return None
+
+    window = tx_window(n, also_ranges)
+
+    if window is None:
+        return None
+
+    tail, delta, results = window
+
+    if rollup_checksum(tail) != rows[0][7]:
+        return None
+
+    _tx["n"] = n
+    _tx["tail"] = tail
+    _tx["table"] = None
+
+    rollup_seed(sums)
+
+    _rollup["persisted_n"] = n
+
+    if delta:
+        tx_extend(delta)
+
+    metric_inc("rollup_restores_total")
+
+    return results
+
+
+def rollup_persist():
+
+    # rewrites the Rollup tab from memory (caller holds _tx_lock)
+
+    ensure_tab("Rollup")
+
+    values = [ROLLUP_HEADER + [str(_tx["n"]), rollup_checksum(_tx["tail"])]]
+
+    for key, (amount, count) in sorted(_rollup["sums"].items()):
+        values.append(list(key) + [amount, count])
+
+    service = get_service()
+
+    service.spreadsheets().values().clear(
+        spreadsheetId=SHEET_ID,
+        range="Rollup!A:H"
+    ).execute()
+
+    service.spreadsheets().values().update(
+        spreadsheetId=SHEET_ID,
+        range="Rollup!A1",
+        valueInputOption="RAW",
+        body={"values": values}
+    ).execute()
+
+    _rollup["persisted_n"] = _tx["n"]
+
+    return len(values) - 1
+
+
+def rollup_maybe_persist():
+
+    if ROLLUP_PERSIST_ROWS and _tx["n"] - _rollup["persisted_n"] >= ROLLUP_PERSIST_ROWS:
+
+        try:
+            rollup_persist()
+        except Exception as e:
+            print("ERROR:", e)
+
+
+def rebuild_rollup():
+
+    # recompute from the full Sheet1 and write it back; returns row count
+
+    if LOCAL_STORE:
+        return local_store().rebuild_rollup()
+
+    with _tx_lock:
+
+        tx_load(get_sheet("Sheet1!A:F"))
+
+        return rollup_persist()
+
+
+def rollup_expense_totals(start_month=None, end_month=None):
+
+    # {category: amount} for months in [start_month, end_month)
+
+    totals = {}
+
+    for (month, type_tx, _, category), (amount, _) in _rollup["sums"].items():
+
+        if type_tx != "expense":
+            continue
+
+        if start_month is not None and not (month and start_month <= month < end_month):
+            continue
+
+        totals[category] = totals.get(category, 0) + amount
+
+    return totals
+
+
+def rollup_uses(column, name):
+
+    # column 2 = account (exact), 3 = category (case-insensitive)
+
+    accounts, categories = _rollup["uses"]
+
+    if column == 2:
+        return accounts.get(name, 0) > 0
+
+    return categories.get(name.casefold(), 0) > 0
+
+
+def ensure_tab(title):
+
+    service = get_service()
+
+    meta = service.spreadsheets().get(
+        spreadsheetId=SHEET_ID,
+        fields="sheets.properties.title"
+    ).execute()
+
+    if any(s["properties"]["title"] == title for s in meta.get("sheets", [])):
+        return
+
+    service.spreadsheets().batchUpdate(
+        spreadsheetId=SHEET_ID,
+        body={"requests": [{"addSheet": {"properties": {"title": title}}}]}
+    ).execute()
+
+
+# ================= LEDGER =================
+
+# running balances, rebuilt from the rollup and extended as rows arrive
+
+LEDGER_SIGNS = {
+    "income": 1,
+    "transfer-in": 1,
+    "expense": -1,
+    "transfer-out": -1
+}
+
+_ledger = {
+    "balances": {},
+    "total": 0
+}
+
+
+def ledger_apply(balances, type_tx, amount, account):
+
+    account = account.strip()
+
+    delta = LEDGER_SIGNS.get(type_tx.strip().lower(), 0) * amount
+
+    balances[account] = balances.get(account, 0) + delta
+
+    return delta
+
+
+def ledger_seed(sums):
+
+    _ledger["balances"] = {}
+    _ledger["total"] = 0
+
+    ledger_extend({key: entry[0] for key, entry in sums.items() if key[0] != ROLLUP_UNPARSED})
+
+
+def ledger_extend(amounts):
+
+    # amounts: {(month, type, account, category): amount}
+
+    balances = _ledger["balances"]
+
+    for (_, type_tx, account, _), amount in amounts.items():
+        _ledger["total"] += ledger_apply(balances, type_tx, amount, account)
+
+
+# ================= TRANSACTION =================
+
+def add_transaction(type_tx, amount, category, account, note=""):
+
+    add_transactions([(type_tx, amount, category, account, note)])
+
+
+def add_transactions(transactions):
+
+    # transactions: list of (type, amount, category, account, note);
+    # all rows go out in one append so multi-leg writes land together
+
+    timestamp = now_wib().strftime("%Y-%m-%d %H:%M:%S")
+
+    append_transaction_rows([
+        [timestamp, type_tx, amount, category, account, note]
+        for type_tx, amount, category, account, note in transactions
+    ])
+
+
+def append_transaction_rows(values):
+
+    # values: complete Sheet1 rows [date, type, amount, category, account, note]
+
+    if LOCAL_STORE:
+
+        local_store().record_transactions([tuple(v) for v in values])
+        return
+
+    if WRITE_BATCH_MS > 0:
+
+        _write_coalescer.submit(values)
+        return
+
+    append_sheet1_rows(values)
+
+
+# QuickClean holds this while it copies and clears Sheet1, so an append
+# from another chat cannot land in between and be cleared unarchived
+_sheet1_write_lock = threading.Lock()
+
+
+def append_sheet1_rows(values):
+
+    service = get_service()
+
+    with _sheet1_write_lock:
+
+        result = service.spreadsheets().values().append(
+            spreadsheetId=SHEET_ID,
+            range="Sheet1!A:F",
+            valueInputOption="RAW",
+            body={"values": values}
+        ).execute()
+
+    tx_record(result.get("updates", {}).get("updatedRange"), values)
+
+
+class WriteCoalescer:
+
+    # The first caller of a batch waits up to window seconds (less if
+    # max_rows arrive first), then flushes every queued row in one call.
+    # The others just wait for that flush; each returns once its rows are
+    # written, or raises the flush's error. Flushes run one at a time so
+    # batches land in order.
+
+    def __init__(self, flush, window, max_rows):
+
+        self.flush = flush
+        self.window = window
+        self.max_rows = max_rows
+        self.lock = threading.Lock()
+        self.flushing = threading.Lock()
+        self.batch = None
+
+    def submit(self, rows):
+
+        with self.lock:
+
+            batch = self.batch
+            leader = batch is None
+
+            if leader:
+
+                batch = self.batch = {
+                    "rows": [],
+                    "full": threading.Event(),
+                    "done": threading.Event(),
+                    "error": None
+                }
+
+            batch["rows"].extend(rows)
+
+            if len(batch["rows"]) >= self.max_rows:
+
+                batch["full"].set()
+                self.batch = None
+
+        if not leader:
+
+            batch["done"].wait()
+
+            if batch["error"] is not None:
+                raise batch["error"]
+
+            return
+
+        batch["full"].wait(self.window)
+
+        with self.lock:
+
+            if self.batch is batch:
+                self.batch = None
+
+        try:
+
+            with self.flushing:
+
+                metric_observe("write_batch_rows", len(batch["rows"]))
+                self.flush(batch["rows"])
+
+        except Exception as e:
+
+            batch["error"] = e
+            raise
+
+        finally:
+
+            batch["done"].set()
+
+
+_write_coalescer = WriteCoalescer(append_sheet1_rows, WRITE_BATCH_MS / 1000, WRITE_BATCH_ROWS)
+
+
+def calculate_account_balance(*also_lists):
+
+    # the Sheet1 delta, the Accounts list and any other list the caller is
+    # about to need (e.g. Categories) go out in a single batchGet
+
+    if LOCAL_STORE:
+
+        balances = local_store().balances()
+        total = sum(balances.values())
+
+        for acc in get_accounts():
+            balances.setdefault(acc, 0)
+
+        return balances, total
+
+    lists = ("Accounts!A:A",) + also_lists
+
+    with _tx_lock:
+
+        results = tx_sync(stale_lists(lists))
+
+        for range_name in lists:
+
+            if range_name in results:
+                fill_list(range_name, results[range_name])
+
+        balances = dict(_ledger["balances"])
+        total = _ledger["total"]
+
+    for acc in get_accounts():
+        balances.setdefault(acc, 0)
+
+    return balances, total
+
+
+# ================= ANALYTICS =================
+
+def get_all_expense_data(start=None, end=None):
+
+    # optional start/end are aware datetimes bounding [start, end)
+
+    if LOCAL_STORE:
+
+        data = local_store().expense_totals(start, end)
+
+        return sorted(data, key=lambda x: x[1], reverse=True), sum(amt for _, amt in data)
+
+    with _tx_lock:
+
+        if start is None:
+
+            tx_sync()
+            data = rollup_expense_totals()
+
+        elif is_month_start(start) and is_month_start(end):
+
+            tx_sync()
+            data = rollup_expense_totals(f"{start.astimezone(WIB):%Y-%m}", f"{end.astimezone(WIB):%Y-%m}")
+
+        else:
+
+            table = tx_table()
+            data = table.expense_totals(table.rows_between(start.timestamp(), end.timestamp()))
+
+    total = sum(data.values())
+
+    sorted_data = sorted(data.items(), key=lambda x: x[1], reverse=True)
+
+    return sorted_data, total
+
+
+def is_month_start(moment):
+
+    moment = moment.astimezone(WIB)
+
+    return moment.day == 1 and moment.time() == datetime.min.time()
+
+
+def period_bounds(period):
+
+    # [start, end) in WIB for a named period, None if unknown
+
+    today = now_wib().replace(hour=0, minute=0, second=0, microsecond=0)
+
+    if period == "Today":
+        return today, today + timedelta(days=1)
+
+    if period == "This Week":
+        start = today - timedelta(days=today.weekday())
+        return start, start + timedelta(days=7)
+
+    if period == "This Month":
+        start = today.replace(day=1)
+        return start, (start + timedelta(days=32)).replace(day=1)
+
+    return None
+
+
+def parse_date_range(text):
+
+    # "YYYY-MM-DD" or "YYYY-MM-DD YYYY-MM-DD", end date inclusive
+
+    parts = text.split()
+
+    try:
+        dates = [datetime.strptime(p, "%Y-%m-%d").replace(tzinfo=WIB) for p in parts]
+    except ValueError:
+        return None
+
+    if len(dates) == 1:
+        dates.append(dates[0])
+
+    if len(dates) != 2 or dates[1] < dates[0]:
+        return None
+
+    return dates[0], dates[1] + timedelta(days=1)
+
+
+# ================= CLEAN =================
+
+def sheet_pages(page_rows, last_row=None, last_col="F"):
+
+    # Sheet1 columns A to last_col from the header down, page_rows rows per
+    # read; up to last_row (skipping blank pages) when given, otherwise
+    # until a page is empty
+
+    first = 1
+
+    while last_row is None or first <= last_row:
+
+        end = first + page_rows - 1
+
+        if last_row is not None:
+            end = min(end, last_row)
+
+        rows = get_sheet(f"Sheet1!A{first}:{last_col}{end}")
+
+        if rows:
+            yield first, rows
+        elif last_row is None:
+            return
+
+        first += page_rows
+
+
+def sheet_row_count(title):
+
+    meta = get_service().spreadsheets().get(
+        spreadsheetId=SHEET_ID,
+        fields="sheets.properties(title,gridProperties.rowCount)"
+    ).execute()
+
+    for sheet in meta.get("sheets", []):
+
+        if sheet["properties"]["title"] == title:
+            return sheet["properties"]["gridProperties"]["rowCount"]
+
+    raise ValueError(f"No tab named {title}")
+
+
+def archive_sheet1(title):
+
+    # copies Sheet1 (header included) into the tab row for row, then clears
+    # exactly the rows it copied; a failure part way leaves Sheet1 untouched
+    # and a retry rewrites the same cells. Blank stretches are skipped, not
+    # taken as the end, and appends from this process wait until it is done.
+
+    ensure_tab(title)
+
+    values_api = get_service().spreadsheets().values()
+
+    with _sheet1_write_lock:
+
+        last_row = sheet_row_count("Sheet1")
+
+        # every column the clear below empties, not only A:F
+        for first, rows in sheet_pages(CLEAN_CHUNK_ROWS, last_row, "Z"):
+
+            values_api.update(
+                spreadsheetId=SHEET_ID,
+                range=f"'{title}'!A{first}",
+                valueInputOption="RAW",
+                body={"values": rows}
+            ).execute()
+
+            metric_inc("clean_archived_rows_total", len(rows))
+
+        if last_row > 1:
+            values_api.clear(spreadsheetId=SHEET_ID, range=f"Sheet1!A2:Z{last_row}").execute()
+
+
+def quick_clean():
+
+    # returns the archive tab name, or None when nothing was archived
+
+    archive = None
+
+    if CLEAN_CHUNK_ROWS > 0:
+        archive = "Archive " + now_wib().strftime("%Y-%m-%d %H%M%S")
+
+    if LOCAL_STORE:
+
+        local_store().clear_transactions(archive)
+
+    elif archive:
+
+        archive_sheet1(archive)
+
+    else:
+
+        with _sheet1_write_lock:
+
+            get_service().spreadsheets().values().clear(
+                spreadsheetId=SHEET_ID,
+                range="Sheet1!A2:Z"
+            ).execute()
+
+    emit("transactions_reset")
+
+    return archive
+
+
+# ================= IMPORT =================
+
+IMPORT_TYPES = {
+    "income": "Income",
+    "expense": "Expense",
+    "transfer-in": "Transfer-In",
+    "transfer-out": "Transfer-Out"
+}
+
+
+def import_csv(lines):
+
+    # lines: any iterable of CSV text lines (file, stream). Rows are the
+    # Sheet1 columns Date, Type, Amount, Category, Account, Note; a first
+    # row starting with "Date" is the header and skipped. Valid rows are
+    # appended IMPORT_CHUNK_ROWS at a time.
+
+    started = time.monotonic()
+
+    accounts = get_list("Accounts!A:A")["names"]
+    categories = get_list("Categories!A:A")["folded"]
+
+    report = {"imported": 0, "rejected": [], "chunks": 0, "seconds": 0.0}
+
+    chunk = []
+    first = True
+
+    for line_no, row in enumerate(csv.reader(lines), start=1):
+
+        if not any(cell.strip() for cell in row):
+            continue
+
+        if first:
+
+            first = False
+
+            if row[0].strip().lower() == "date":
+                continue
+
+        values, error = import_row(row, accounts, categories)
+
+        if error:
+
+            report["rejected"].append((line_no, error))
+            continue
+
+        chunk.append(values)
+
+        if len(chunk) >= IMPORT_CHUNK_ROWS:
+
+            append_transaction_rows(chunk)
+
+            report["imported"] += len(chunk)
+            report["chunks"] += 1
+
+            chunk = []
+
+    if chunk:
+
+        append_transaction_rows(chunk)
+
+        report["imported"] += len(chunk)
+        report["chunks"] += 1
+
+    report["seconds"] = time.monotonic() - started
+
+    return report
+
+
+def import_row(row, accounts, categories):
+
+    # returns (sheet row, None) or (None, reason)
+
+    row = [cell.strip() for cell in row] + [""] * (6 - len(row))
+
+    date, type_tx, amount, category, account, note = row[:6]
+
+    timestamp = parse_timestamp(date)
+
+    if timestamp != timestamp:
+        return None, f"bad date {date!r}"
+
+    type_tx = IMPORT_TYPES.get(type_tx.lower())
+
+    if not type_tx:
+        return None, f"bad type {row[1]!r}"
+
+    amount = parse_amount(amount)
+
+    if not amount:
+        return None, f"bad amount {row[2]!r}"
+
+    if account not in accounts:
+        return None, f"unknown account {account!r}"
+
+    if type_tx == "Expense":
+
+        if category.casefold() not in categories:
+            return None, f"unknown category {category!r}"
+
+        category = categories[category.casefold()]
+
+    date = datetime.fromtimestamp(timestamp, WIB).strftime("%Y-%m-%d %H:%M:%S")
+
+    return [date, type_tx, amount, category, account, note], None
+
+
+def format_import_report(report):
+
+    seconds = max(report["seconds"], 1e-9)
+
+    msg = (
+        f"Imported {report['imported']} rows in {report['chunks']} appends, "
+        f"{report['seconds']:.1f}s ({report['imported'] / seconds:,.0f} rows/s)."
+    )
+
+    rejected = report["rejected"]
+
+    if rejected:
+
+        msg += f"\nRejected {len(rejected)} lines:\n"
+
+        for line_no, error in rejected[:20]:
+            msg += f"line {line_no}: {error}\n"
+
+        if len(rejected) > 20:
+            msg += f"... and {len(rejected) - 20} more\n"
+
+    return msg
+
+
+# ================= EXPORT =================
+
+def export_rows(start=None, end=None):
+
+    # yields Sheet1 rows (header first), optionally only those dated in
+    # [start, end); Sheet1 is read EXPORT_PAGE_ROWS rows at a time down to
+    # the end of its grid, so a blank stretch does not end the export
+
+    if LOCAL_STORE:
+
+        yield from local_store().export_rows(start, end)
+        return
+
+    header = True
+
+    for _, rows in sheet_pages(EXPORT_PAGE_ROWS, sheet_row_count("Sheet1")):
+
+        for row in rows:
+
+            if header:
+
+                header = False
+                yield row
+                continue
+
+            if not row:
+                continue
+
+            if start is not None:
+
+                timestamp = parse_timestamp(row[0])
+
+                if not start.timestamp() <= timestamp < end.timestamp():
+                    continue
+
+            yield row
+
+
+def export_csv(start=None, end=None):
+
+    # returns (binary file positioned at 0, data row count); small exports
+    # stay in memory, large ones spill to a temp file. Rows are written to
+    # a text buffer that goes into the spool encoded once per page
+    # (TextIOWrapper over a SpooledTemporaryFile needs Python 3.11)
+
+    spool = tempfile.SpooledTemporaryFile(max_size=EXPORT_SPOOL_BYTES, mode="w+b")
+
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+
+    def flush():
+
+        spool.write(buffer.getvalue().encode("utf-8"))
+
+        buffer.seek(0)
+        buffer.truncate()
+
+    count = -1
+
+    for row in export_rows(start, end):
+
+        writer.writerow(row)
+        count += 1
+
+        if count % EXPORT_PAGE_ROWS == 0:
+            flush()
+
+    flush()
+
+    spool.seek(0)
+
+    return spool, max(count, 0)
+
+
+# ================= TELEGRAM =================
+
+# one keep-alive session for all outgoing calls so replies reuse the
+# TLS connection to api.telegram.org instead of handshaking every time
+
+_telegram_session = None
+_telegram_session_lock = threading.Lock()
+
+
+def get_telegram_session():
+
+    global _telegram_session
+
+    with _telegram_session_lock:
+
+        if _telegram_session is None:
+
+            workers = max(1, SERVER_WORKERS, UPDATE_QUEUE_WORKERS)
+
+            session = requests.Session()
+            session.mount("https://", HTTPAdapter(pool_connections=1, pool_maxsize=workers))
+
+            _telegram_session = session
+
+        return _telegram_session
+
+
+def telegram_call(method, payload, files=None):
+
+    # retries 429 and 5xx with exponential backoff, honouring the
+    # retry_after Telegram sends with flood-control errors. With files
+    # ({field: (name, fileobj, mime)}) the call is a multipart upload.
+
+    url = f"https://api.telegram.org/bot{BOT_TOKEN}/{method}"
+
+    session = get_telegram_session()
+
+    for attempt in range(TELEGRAM_RETRIES + 1):
+
+        delay = 0.5 * 2 ** attempt
+
+        try:
+
+            with span("telegram_call_seconds", method=method):
+
+                if files:
+
+                    for _, fileobj, _ in files.values():
+                        fileobj.seek(0)
+
+                    response = session.post(
+                        url,
+                        data=payload,
+                        files=files,
+                        timeout=(TELEGRAM_CONNECT_TIMEOUT, TELEGRAM_READ_TIMEOUT)
+                    )
+
+                else:
+
+                    response = session.post(
+                        url,
+                        json=payload,
+                        timeout=(TELEGRAM_CONNECT_TIMEOUT, TELEGRAM_READ_TIMEOUT)
+                    )
+
+        except requests.RequestException:
+
+            if attempt == TELEGRAM_RETRIES:
+                raise
+
+        else:
+
+            if response.status_code != 429 and response.status_code < 500:
+                return response
+
+            if attempt == TELEGRAM_RETRIES:
+                return response
+
+            try:
+                delay = response.json()["parameters"]["retry_after"]
+            except Exception:
+                pass
+
+        time.sleep(delay)
+
+
+# when a webhook is answering inline, send() parks the latest payload here
+# instead of posting it; an earlier one is posted as soon as a newer arrives
+
+_reply_local = threading.local()
+
+
+@contextmanager
+def telegram_download(file_id):
+
+    # streams a file sent to the bot as text, without loading it whole;
+    # the response is closed when the with block ends
+
+    result = telegram_call("getFile", {"file_id": file_id}).json()["result"]
+
+    response = get_telegram_session().get(
+        f"https://api.telegram.org/file/bot{BOT_TOKEN}/{result['file_path']}",
+        stream=True,
+        timeout=(TELEGRAM_CONNECT_TIMEOUT, TELEGRAM_READ_TIMEOUT)
+    )
+
+    try:
+
+        response.raise_for_status()
+        response.raw.decode_content = True
+
+        yield io.TextIOWrapper(response.raw, encoding="utf-8-sig", newline="")
+
+    finally:
+
+        response.close()
+
+
+def send(chat_id, text, keyboard=None):
+
+    payload = {
+        "chat_id": chat_id,
+        "text": text
+    }
+
+    if keyboard:
+
+        payload["reply_markup"] = {
+            "keyboard": keyboard,
+            "resize_keyboard": True
+        }
+
+    pending = getattr(_reply_local, "pending", None)
+
+    if pending is None:
+
+        telegram_call("sendMessage", payload)
+        return
+
+    if pending:
+        telegram_call("sendMessage", pending.pop())
+
+    pending.append(payload)
+
+
+def send_document(chat_id, filename, fileobj, caption="", keyboard=None):
+
+    # anything parked for an inline reply has to go out first to keep order
+
+    pending = getattr(_reply_local, "pending", None)
+
+    if pending:
+        telegram_call("sendMessage", pending.pop())
+
+    payload = {
+        "chat_id": chat_id,
+        "caption": caption
+    }
+
+    if keyboard:
+
+        payload["reply_markup"] = json.dumps({
+            "keyboard": keyboard,
+            "resize_keyboard": True
+        })
+
+    telegram_call("sendDocument", payload, {"document": (filename, fileobj, "text/csv")})
+
+
+def main_menu():
+
+    return [
+        ["Spending","Balance"],
+        ["Income","Transfer","Expense"],
+        ["Management","QuickClean"],
+    ]
+
+
+# ================= CONCURRENCY =================
+
+# one lock per chat so a chat's updates run in order while different chats
+# run in parallel; entries are refcounted and dropped once nobody holds them
+
+_chat_locks = {}
+_chat_locks_guard = threading.Lock()
+
+
+def chat_lock_acquire(chat_id):
+
+    with _chat_locks_guard:
+
+        entry = _chat_locks.setdefault(chat_id, [threading.Lock(), 0])
+        entry[1] += 1
+
+    entry[0].acquire()
+
+
+def chat_lock_release(chat_id):
+
+    with _chat_locks_guard:
+
+        entry = _chat_locks[chat_id]
+        entry[1] -= 1
+
+        if entry[1] == 0:
+            del _chat_locks[chat_id]
+
+    entry[0].release()
+
+
+class PooledHTTPServer(HTTPServer):
+
+    # like ThreadingHTTPServer, but requests run on a fixed pool and the
+    # accept loop blocks once every worker is busy
+
+    def __init__(self, server_address, handler_class, workers):
+
+        super().__init__(server_address, handler_class)
+
+        self.pool = ThreadPoolExecutor(max_workers=workers)
+        self.slots = threading.BoundedSemaphore(workers)
+
+    def process_request(self, request, client_address):
+
+        self.slots.acquire()
+        self.pool.submit(self.process_request_thread, request, client_address)
+
+    def process_request_thread(self, request, client_address):
+
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+            self.slots.release()
+
+    def server_close(self):
+
+        super().server_close()
+        self.pool.shutdown(wait=True)
+
+
+# ================= DISPATCH =================
+
+# commands are keyed by message text, flow steps by (flow, step); a
+# single-step flow registers step None. Registration order is the priority:
+# a command registered before the active flow wins over it, one registered
+# after it is treated as input to the flow.
+
+COMMANDS = {}
+FLOW_STEPS = {}
+DOCUMENT_STEPS = {}
+
+_handler_order = itertools.count()
+
+
+def command(text):
+
+    def register(fn):
+        COMMANDS[text] = (next(_handler_order), fn)
+        return fn
+
+    return register
+
+
+def flow_step(flow, step=None):
+
+    def register(fn):
+        FLOW_STEPS[(flow, step)] = (next(_handler_order), fn)
+        return fn
+
+    return register
+
+
+def document_step(flow):
+
+    # a file sent while the chat is in this flow; fn(chat_id, document, state)
+
+    def register(fn):
+        DOCUMENT_STEPS[flow] = fn
+        return fn
+
+    return register
+
+
+def handle_message(chat_id, text, document=None):
+
+    state = user_states.get(chat_id)
+
+    if document is not None:
+
+        handler = DOCUMENT_STEPS.get(state.get("flow")) if state else None
+
+        try:
+
+            if handler:
+
+                with span("handler_seconds", handler=handler.__name__):
+                    handler(chat_id, document, state)
+
+            else:
+                send(chat_id, "Use menu.", main_menu())
+
+        finally:
+
+            user_states.commit(chat_id)
+
+        return
+
+    cmd = COMMANDS.get(text)
+    step = None
+
+    if state:
+        step = FLOW_STEPS.get((state.get("flow"), state.get("step")))
+
+    if cmd and (not step or cmd[0] < step[0]):
+        handler = cmd[1]
+    elif step:
+        handler = step[1]
+    else:
+        handler = None
+
+    try:
+
+        if handler:
+
+            with span("handler_seconds", handler=handler.__name__):
+                handler(chat_id, text, state)
+
+            return
+
+        send(chat_id, "Use menu.", main_menu())
+
+    finally:
+
+        user_states.commit(chat_id)
+
+
+# ================= FLOWS =================
+
+@command("Back")
+def back(chat_id, text, state):
+
+    user_states.pop(chat_id, None)
+
+    send(chat_id, "Back to main menu.", main_menu())
+
+
+@command("/start")
+def start(chat_id, text, state):
+
+    send(chat_id, "Finance Bot Ready.", main_menu())
+
+
+# ================= INCOME =================
+
+@command("Income")
+def income_start(chat_id, text, state):
+
+    accounts = get_accounts()
+
+    if not accounts:
+
+        send(chat_id, "No accounts found. Add account first.", main_menu())
+        return
+
+    user_states[chat_id] = {
+        "flow": "income",
+        "step": "account",
+        "data": {}
+    }
+
+    send(chat_id, "Select account:", keyboard_3col(accounts))
+
+
+@flow_step("income", "account")
+def income_account(chat_id, text, state):
+
+    if not account_exists(text):
+
+        send(chat_id, "Invalid account.")
+        return
+
+    state["data"]["account"] = text
+    state["step"] = "amount"
+
+    send(chat_id, "Enter amount:")
+
+
+@flow_step("income", "amount")
+def income_amount(chat_id, text, state):
+
+    amount = parse_amount(text)
+
+    if not amount:
+
+        send(chat_id, "Invalid amount.")
+        return
+
+    state["data"]["amount"] = amount
+    state["step"] = "note"
+
+    send(chat_id, "Enter note (or type skip):")
+
+
+@flow_step("income", "note")
+def income_note(chat_id, text, state):
+
+    note = "" if text.lower() == "skip" else text
+
+    d = state["data"]
+
+    add_transaction(
+        "Income",
+        d["amount"],
+        "",
+        d["account"],
+        note
+    )
+
+    send(chat_id, "Income recorded.", main_menu())
+
+    user_states.pop(chat_id)
+
+
+# ================= EXPENSE =================
+
+@command("Expense")
+def expense_start(chat_id, text, state):
+
+    accounts = get_accounts()
+
+    if not accounts:
+
+        send(chat_id, "No accounts found. Add account first.", main_menu())
+        return
+
+    user_states[chat_id] = {
+        "flow": "expense",
+        "step": "account",
+        "data": {}
+    }
+
+    send(chat_id, "Select account:", keyboard_3col(accounts))
+
+
+@flow_step("expense", "account")
+def expense_account(chat_id, text, state):
+
+    if not account_exists(text):
+
+        send(chat_id, "Invalid account.")
+        return
+
+    state["data"]["account"] = text
+    state["step"] = "amount"
+
+    send(chat_id, "Enter amount:")
+
+
+@flow_step("expense", "amount")
+def expense_amount(chat_id, text, state):
+
+    amount = parse_amount(text)
+
+    if not amount:
+
+        send(chat_id, "Invalid amount.")
+        return
+
+    balances, _ = calculate_account_balance("Categories!A:A")
+
+    if balances.get(state["data"]["account"], 0) < amount:
+
+        send(chat_id, "Insufficient balance.", main_menu())
+
+        user_states.pop(chat_id)
+        return
+
+    state["data"]["amount"] = amount
+    state["step"] = "category"
+
+    cats = get_categories()
+
+    if cats:
+        send(chat_id,"Select category or type new:",keyboard_category(cats))
+    else:
+        send(chat_id,"Enter category:")
+
+
+@flow_step("expense", "category")
+def expense_category(chat_id, text, state):
+
+    category = text.strip()
+
+    if not category_exists(category):
+        add_category(category)
+
+    state["data"]["category"] = category
+    state["step"] = "note"
+
+    send(chat_id, "Enter note (or type skip):")
+
+
+@flow_step("expense", "note")
+def expense_note(chat_id, text, state):
+
+    note = "" if text.lower() == "skip" else text
+
+    d = state["data"]
+
+    add_transaction(
+        "Expense",
+        d["amount"],
+        d["category"],
+        d["account"],
+        note
+    )
+
+    send(chat_id, "Expense recorded.", main_menu())
+
+    user_states.pop(chat_id)
+
+
+# ================= TRANSFER =================
+
+@command("Transfer")
+def transfer_start(chat_id, text, state):
+
+    accounts = get_accounts()
+
+    if not accounts:
+
+        send(chat_id, "No accounts found.", main_menu())
+        return
+
+    user_states[chat_id] = {
+        "flow": "transfer",
+        "step": "from",
+        "data": {}
+    }
+
+    send(chat_id, "Transfer from:", keyboard_3col(accounts))
+
+
+@flow_step("transfer", "from")
+def transfer_from(chat_id, text, state):
+
+    if not account_exists(text):
+
+        send(chat_id, "Invalid account.")
+        return
+
+    state["data"]["from"] = text
+    state["step"] = "to"
+
+    send(chat_id, "Transfer to:", keyboard_3col(get_accounts()))
+
+
+@flow_step("transfer", "to")
+def transfer_to(chat_id, text, state):
+
+    if not account_exists(text) or text == state["data"]["from"]:
+
+        send(chat_id, "Invalid destination.")
+        return
+
+    state["data"]["to"] = text
+    state["step"] = "amount"
+
+    send(chat_id, "Enter amount:")
+
+
+@flow_step("transfer", "amount")
+def transfer_amount(chat_id, text, state):
+
+    amount = parse_amount(text)
+
+    if not amount:
+
+        send(chat_id, "Invalid amount.")
+        return
+
+    balances, _ = calculate_account_balance()
+
+    if balances.get(state["data"]["from"], 0) < amount:
+
+        send(chat_id, "Insufficient balance.", main_menu())
+
+        user_states.pop(chat_id)
+        return
+
+    add_transactions([
+        (
+            "Transfer-Out",
+            amount,
+            "Transfer",
+            state["data"]["from"],
+            f"To {state['data']['to']}"
+        ),
+        (
+            "Transfer-In",
+            amount,
+            "Transfer",
+            state["data"]["to"],
+            f"From {state['data']['from']}"
+        )
+    ])
+
+    send(chat_id, "Transfer completed.", main_menu())
+
+    user_states.pop(chat_id)
+
+
+# ================= BALANCE =================
+
+@command("Balance")
+def balance(chat_id, text, state):
+
+    balances, total = calculate_account_balance()
+
+    msg = ""
+
+    for acc, bal in sorted(balances.items(), key=lambda x: x[1], reverse=True):
+
+        msg += f"{acc}: {format_currency(bal)}\n"
+
+    msg += "\nTOTAL: " + format_currency(total)
+
+    send(chat_id, msg, main_menu())
+
+
+# ================= MANAGEMENT =================
+
+@command("Management")
+def management(chat_id, text, state):
+
+    send(chat_id,"Management:",[["Accounts","Categories"],["Import","Export","Rollup"],["Back"]])
+
+
+# ===== ACCOUNT MANAGEMENT =====
+
+@command("Accounts")
+def accounts_menu(chat_id, text, state):
+
+    send(chat_id,"Account Management:",[["List","Add"],["Delete","Back"]])
+
+
+@command("List")
+def accounts_list(chat_id, text, state):
+
+    balances, _ = calculate_account_balance()
+
+    msg = ""
+
+    for acc in get_accounts():
+
+        msg += f"{acc}: {format_currency(balances.get(acc,0))}\n"
+
+    send(chat_id, msg, main_menu())
+
+
+@command("Add")
+def account_add_start(chat_id, text, state):
+
+    user_states[chat_id] = {"flow": "add_account"}
+
+    send(chat_id, "Enter new account name:")
+
+
+@flow_step("add_account")
+def account_add(chat_id, text, state):
+
+    if account_exists(text):
+
+        send(chat_id, "Account already exists.", main_menu())
+
+    else:
+
+        add_account(text)
+
+        send(chat_id, "Account added.", main_menu())
+
+    user_states.pop(chat_id)
+
+
+@command("Delete")
+def account_delete_start(chat_id, text, state):
+
+    user_states[chat_id] = {"flow": "delete_account"}
+
+    send(chat_id, "Enter account name to delete:")
+
+
+@flow_step("delete_account")
+def account_delete(chat_id, text, state):
+
+    if not account_exists(text):
+
+        send(chat_id, "Account not found.", main_menu())
+
+    elif not delete_account(text):
+
+        send(chat_id, "Account has transactions. Cannot delete.", main_menu())
+
+    else:
+
+        send(chat_id, "Account deleted.", main_menu())
+
+    user_states.pop(chat_id)
+
+
+# ===== CATEGORY MANAGEMENT =====
+
+@command("Categories")
+def categories_menu(chat_id, text, state):
+
+    send(chat_id,"Category Management:",[["CatList","CatAdd"],["CatDelete","Back"]])
+
+
+@command("CatList")
+def categories_list(chat_id, text, state):
+
+    cats = get_categories()
+
+    if not cats:
+
+        send(chat_id,"No categories.",main_menu())
+
+    else:
+
+        msg = "Categories:\n\n"
+
+        for i,c in enumerate(cats,start=1):
+
+            msg += f"{i}. {c}\n"
+
+        send(chat_id,msg,main_menu())
+
+
+@command("CatAdd")
+def category_add_start(chat_id, text, state):
+
+    user_states[chat_id]={"flow":"add_category"}
 
-                    send(chat_id,"Category deleted.",main_menu())
+    send(chat_id,"Enter category name:")
 
-                user_states.pop(chat_id)
 
-                self.send_response(200)
-                self.end_headers()
-                return
+@flow_step("add_category")
+def category_add(chat_id, text, state):
 
+    if category_exists(text):
 
-            # ================= ALL EXPENSE =================
+        send(chat_id,"Category already exists.",main_menu())
 
-            if text == "Spending":
+    else:
 
-                data_exp, total = get_all_expense_data()
+        add_category(text)
 
-                if not data_exp:
+        send(chat_id,"Category added.",main_menu())
 
-                    send(chat_id, "No expense recorded.", main_menu())
+    user_states.pop(chat_id)
 
-                else:
 
-                    msg = f"Total Expense: {format_currency(total)}\n\n"
+@command("CatDelete")
+def category_delete_start(chat_id, text, state):
+
+    user_states[chat_id]={"flow":"delete_category"}
+
+    send(chat_id,"Enter category to delete:")
+
+
+@flow_step("delete_category")
+def category_delete(chat_id, text, state):
+
+    if not category_exists(text):
+
+        send(chat_id,"Category not found.",main_menu())
+
+    elif not delete_category(text):
+
+        send(chat_id,"Category used in transactions.",main_menu())
+
+    else:
+
+        send(chat_id,"Category deleted.",main_menu())
+
+    user_states.pop(chat_id)
+
+
+# ================= ALL EXPENSE =================
+
+PERIOD_KEYBOARD = [["Today","This Week","This Month"],["All Time","Custom"],["Back"]]
+
+
+@command("Spending")
+def spending_start(chat_id, text, state):
+
+    user_states[chat_id] = {"flow": "spending", "step": "period"}
+
+    send(chat_id, "Select period:", PERIOD_KEYBOARD)
+
+
+@flow_step("spending", "period")
+def spending_period(chat_id, text, state):
+
+    if text == "Custom":
+
+        state["step"] = "range"
+
+        send(chat_id, "Enter dates as YYYY-MM-DD YYYY-MM-DD:")
+        return
+
+    if text == "All Time":
+
+        send_spending(chat_id, None, None, None)
+
+    else:
+
+        bounds = period_bounds(text)
+
+        if not bounds:
+
+            send(chat_id, "Invalid period.")
+            return
+
+        send_spending(chat_id, text, *bounds)
+
+    user_states.pop(chat_id)
+
+
+@flow_step("spending", "range")
+def spending_range(chat_id, text, state):
+
+    bounds = parse_date_range(text)
+
+    if not bounds:
+
+        send(chat_id, "Invalid dates.")
+        return
+
+    start, end = bounds
+
+    label = f"{start:%Y-%m-%d} to {end - timedelta(days=1):%Y-%m-%d}"
+
+    send_spending(chat_id, label, start, end)
+
+    user_states.pop(chat_id)
+
+
+def send_spending(chat_id, label, start, end):
+
+    data_exp, total = get_all_expense_data(start, end)
+
+    if not data_exp:
+
+        send(chat_id, "No expense recorded.", main_menu())
+
+    else:
+
+        title = "Total Expense" if label is None else f"Total Expense ({label})"
+
+        msg = f"{title}: {format_currency(total)}\n\n"
+
+        for i,(cat,amt) in enumerate(data_exp,start=1):
+
+            msg += f"{i}. {cat} — {format_currency(amt)}\n"
+
+        send(chat_id, msg, main_menu())
+
+
+# ================= QUICK CLEAN =================
+
+@command("QuickClean")
+def clean_start(chat_id, text, state):
+
+    user_states[chat_id] = {"flow": "clean_confirm"}
+
+    send(chat_id, "Type YES to confirm deleting all transactions.")
+
+
+@flow_step("clean_confirm")
+def clean_confirm(chat_id, text, state):
+
+    if text == "YES":
+
+        archive = quick_clean()
+
+        if archive:
+            send(chat_id, f"All transactions moved to the {archive} tab.", main_menu())
+        else:
+            send(chat_id, "All transactions deleted.", main_menu())
+
+    else:
+
+        send(chat_id, "Cancelled.", main_menu())
+
+    user_states.pop(chat_id)
+
+
+# ================= ROLLUP =================
+
+# registered last so it never takes over a flow's free-text input
+
+@command("Rollup")
+def rollup_rebuild(chat_id, text, state):
+
+    count = rebuild_rollup()
+
+    send(chat_id, f"Rollup rebuilt: {count} rows.", main_menu())
+
+
+# ================= IMPORT =================
+
+@command("Import")
+def import_start(chat_id, text, state):
+
+    user_states[chat_id] = {"flow": "import"}
+
+    send(chat_id, "Send a CSV file with columns Date, Type, Amount, Category, Account, Note.")
+
+
+@flow_step("import")
+def import_waiting(chat_id, text, state):
+
+    send(chat_id, "Send a CSV file, or Back to cancel.")
+
+
+@document_step("import")
+def import_file(chat_id, document, state):
+
+    send(chat_id, "Importing...")
+
+    with telegram_download(document["file_id"]) as lines:
+        report = import_csv(lines)
+
+    send(chat_id, format_import_report(report), main_menu())
+
+    user_states.pop(chat_id)
+
+
+# ================= EXPORT =================
+
+@command("Export")
+def export_start(chat_id, text, state):
+
+    user_states[chat_id] = {"flow": "export", "step": "period"}
+
+    send(chat_id, "Export which period?", PERIOD_KEYBOARD)
+
+
+@flow_step("export", "period")
+def export_period(chat_id, text, state):
+
+    if text == "Custom":
+
+        state["step"] = "range"
+
+        send(chat_id, "Enter dates as YYYY-MM-DD YYYY-MM-DD:")
+        return
+
+    if text == "All Time":
+
+        send_export(chat_id, None, None)
+
+    else:
+
+        bounds = period_bounds(text)
+
+        if not bounds:
+
+            send(chat_id, "Invalid period.")
+            return
+
+        send_export(chat_id, *bounds)
+
+    user_states.pop(chat_id)
+
+
+@flow_step("export", "range")
+def export_range(chat_id, text, state):
+
+    bounds = parse_date_range(text)
+
+    if not bounds:
+
+        send(chat_id, "Invalid dates.")
+        return
+
+    send_export(chat_id, *bounds)
+
+    user_states.pop(chat_id)
+
+
+def send_export(chat_id, start, end):
+
+    if start is None:
+        filename = "transactions.csv"
+    else:
+        filename = f"transactions-{start:%Y%m%d}-{end - timedelta(days=1):%Y%m%d}.csv"
+
+    fileobj, count = export_csv(start, end)
+
+    with fileobj:
+        send_document(chat_id, filename, fileobj, f"{count} transactions.", main_menu())
+
+
+# ================= UPDATE QUEUE =================
+
+# ack-first mode: do_POST only validates and enqueues, workers run the flows.
+# Updates are sharded by chat so each chat is handled in order by one worker.
+
+_update_queues = []
+_update_queues_lock = threading.Lock()
+
+
+def process_update(chat_id, text, document=None):
+
+    chat_lock_acquire(chat_id)
+
+    _sheets_calls.count = 0
+
+    try:
+        handle_message(chat_id, text, document)
+    finally:
+        chat_lock_release(chat_id)
+        metric_observe("sheets_calls_per_update", _sheets_calls.count)
+
+
+def process_update_inline(chat_id, text, document=None):
+
+    # returns the step's final reply as a webhook response method call,
+    # or None if the step sent nothing
+
+    pending = []
+
+    _reply_local.pending = pending
+
+    try:
+        process_update(chat_id, text, document)
+    except Exception:
+        _reply_local.pending = None
+        for payload in pending:
+            telegram_call("sendMessage", payload)
+        raise
+
+    _reply_local.pending = None
+
+    if not pending:
+        return None
+
+    return {"method": "sendMessage", **pending[0]}
+
+
+def update_worker(q):
+
+    while True:
+
+        chat_id, text, document, enqueued = q.get()
+
+        started = time.monotonic()
+
+        metric_observe("update_queue_wait_seconds", started - enqueued)
+
+        try:
+            process_update(chat_id, text, document)
+        except Exception as e:
+            print("ERROR:", e)
+            metric_inc("update_errors_total")
+        finally:
+            metric_observe("update_processing_seconds", time.monotonic() - started)
+            metric_set("update_queue_depth", update_queue_depth())
+            q.task_done()
+
+
+def start_update_workers():
+
+    with _update_queues_lock:
+
+        if _update_queues:
+            return
+
+        size = max(1, UPDATE_QUEUE_SIZE // UPDATE_QUEUE_WORKERS)
+
+        for _ in range(UPDATE_QUEUE_WORKERS):
+
+            q = queue.Queue(maxsize=size)
+
+            threading.Thread(target=update_worker, args=(q,), daemon=True).start()
+
+            _update_queues.append(q)
+
+
+def update_queue_depth():
+
+    return sum(q.qsize() for q in _update_queues)
+
+
+def enqueue_update(chat_id, text, document=None):
+
+    # returns False when the chat's shard is full so the caller can answer
+    # non-2xx and let Telegram redeliver later
+
+    start_update_workers()
+
+    q = _update_queues[hash(chat_id) % len(_update_queues)]
+
+    try:
+        q.put_nowait((chat_id, text, document, time.monotonic()))
+    except queue.Full:
+        metric_inc("update_queue_rejected_total")
+        return False
+
+    metric_set("update_queue_depth", update_queue_depth())
+
+    return True
+
+
+# ================= DEDUP =================
+
+class UpdateDedup:
+
+    # ring buffer of (seen, update_id) in arrival order plus a dict for the
+    # lookup; entries leave when they age out of the window or the ring is
+    # full. With a path, ids also go to SQLite so a restart or another
+    # process still recognises them.
+
+    def __init__(self, window, size, path=""):
+
+        self.window = window
+        self.size = size
+        self.ring = deque()
+        self.seen = {}
+        self.lock = threading.Lock()
+        self.writes = 0
+        self.db = None
+
+        if path:
+
+            self.db = sqlite3.connect(path, timeout=10, check_same_thread=False, isolation_level=None)
+            self.db.execute("PRAGMA journal_mode=WAL")
+            self.db.execute(
+                "CREATE TABLE IF NOT EXISTS updates ("
+                "update_id INTEGER PRIMARY KEY, seen REAL NOT NULL)"
+            )
+
+    def check(self, update_id):
+
+        # True if update_id is a repeat; otherwise records it
+
+        now = time.time()
+
+        with self.lock:
+
+            while self.ring and (len(self.ring) >= self.size or self.ring[0][0] <= now - self.window):
+
+                seen, old = self.ring.popleft()
+
+                if self.seen.get(old) == seen:
+                    del self.seen[old]
+
+            if update_id in self.seen:
+                return True
+
+            if self.db is not None and self.stored(update_id, now):
+                return True
+
+            self.seen[update_id] = now
+            self.ring.append((now, update_id))
+
+            return False
+
+    def stored(self, update_id, now):
 
-                    for i,(cat,amt) in enumerate(data_exp,start=1):
+        row = self.db.execute("SELECT seen FROM updates WHERE update_id = ?", (update_id,)).fetchone()
 
-                        msg += f"{i}. {cat} — {format_currency(amt)}\n"
+        if row is not None and row[0] > now - self.window:
+            return True
 
-                    send(chat_id, msg, main_menu())
+        self.db.execute("INSERT OR REPLACE INTO updates (update_id, seen) VALUES (?, ?)", (update_id, now))
+
+        self.writes += 1
+
+        if self.writes % 100 == 0:
+            self.db.execute("DELETE FROM updates WHERE seen <= ?", (now - self.window,))
+
+        return False
+
+    def forget(self, update_id):
+
+        # for updates we turned away, so Telegram's retry gets processed
+
+        with self.lock:
+
+            self.seen.pop(update_id, None)
+
+            if self.db is not None:
+                self.db.execute("DELETE FROM updates WHERE update_id = ?", (update_id,))
+
+
+update_dedup = UpdateDedup(DEDUP_WINDOW, DEDUP_SIZE, DEDUP_DB)
+
+
+# ================= HANDLER =================
+
+class handler(BaseHTTPRequestHandler):
+
+    def do_POST(self):
+
+        length = int(self.headers.get('Content-Length', 0))
+        body = self.rfile.read(length)
+
+        try:
+
+            data = json.loads(body)
+
+            update_id = data.get("update_id")
+
+            if update_id is not None and update_dedup.check(update_id):
+
+                metric_inc("updates_duplicate_total")
 
                 self.send_response(200)
                 self.end_headers()
                 return
 
+            if "message" not in data:
 
-            # ================= QUICK CLEAN =================
-
-            if text == "QuickClean":
+                self.send_response(200)
+                self.end_headers()
+                return
 
-                user_states[chat_id] = {"flow": "clean_confirm"}
+            message = data.get("message", {})
+            chat_id = message.get("chat", {}).get("id")
+            text = message.get("text", "").strip()
+            document = message.get("document")
+            user_id = message.get("from", {}).get("id")
 
-                send(chat_id, "Type YES to confirm deleting all transactions.")
+            if user_id not in ALLOWED_USERS:
 
                 self.send_response(200)
                 self.end_headers()
                 return
 
+            if UPDATE_QUEUE_WORKERS:
 
-            if state and state.get("flow") == "clean_confirm":
+                if not enqueue_update(chat_id, text, document):
 
-                if text == "YES":
+                    update_dedup.forget(update_id)
 
-                    quick_clean()
+                    self.send_response(503)
+                    self.end_headers()
+                    return
 
-                    send(chat_id, "All transactions deleted.", main_menu())
+            elif INLINE_REPLY:
 
-                else:
+                reply = process_update_inline(chat_id, text, document)
 
-                    send(chat_id, "Cancelled.", main_menu())
+                if reply:
 
-                user_states.pop(chat_id)
+                    payload = json.dumps(reply).encode()
 
-                self.send_response(200)
-                self.end_headers()
-                return
+                    self.send_response(200)
+                    self.send_header("Content-Type", "application/json")
+                    self.send_header("Content-Length", str(len(payload)))
+                    self.end_headers()
+                    self.wfile.write(payload)
+                    return
 
+            else:
 
-            send(chat_id, "Use menu.", main_menu())
+                process_update(chat_id, text, document)
 
             self.send_response(200)
             self.end_headers()
@@ -1039,6 +3767,14 @@ class handler(BaseHTTPRequestHandler):
 
     def do_GET(self):
 
+        if self.path.split("?")[0] == "/metrics":
+
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.end_headers()
+            self.wfile.write(render_metrics().encode())
+            return
+
         self.send_response(200)
         self.end_headers()
         self.wfile.write(b"Bot running")
@@ -1048,16 +3784,42 @@ class handler(BaseHTTPRequestHandler):
 
 if __name__ == "__main__":
 
-    if not BOT_TOKEN:
-        raise ValueError("BOT_TOKEN environment variable not set")
-
     if not SHEET_ID:
         raise ValueError("SHEET_ID environment variable not set")
 
+    if sys.argv[1:2] == ["import"]:
+
+        # python api/webhook.py import history.csv [more.csv ...]
+
+        # the loop below drains the journal; a background syncer would
+        # replay the same entries alongside it
+        if LOCAL_STORE:
+            local_store(background=False)
+
+        for path in sys.argv[2:]:
+
+            with open(path, newline="", encoding="utf-8-sig") as f:
+                print(path + ":", format_import_report(import_csv(f)))
+
+        if LOCAL_STORE and LOCAL_SYNC:
+
+            while local_store().sync_once():
+                pass
+
+        sys.exit(0)
+
+    if not BOT_TOKEN:
+        raise ValueError("BOT_TOKEN environment variable not set")
+
     PORT = int(os.environ.get("PORT", 8080))
 
-    server = HTTPServer(("", PORT), handler)
+    if SERVER_MODE == "threaded":
+        server = PooledHTTPServer(("", PORT), handler, SERVER_WORKERS)
+    elif SERVER_MODE == "single":
+        server = HTTPServer(("", PORT), handler)
+    else:
+        raise ValueError(f"Unknown SERVER_MODE: {SERVER_MODE}")
 
-    print("Server running on port", PORT)
+    print("Server running on port", PORT, "mode", SERVER_MODE)
 
     server.serve_forever()
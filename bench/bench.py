@@ -0,0 +1,239 @@
+import argparse
+import json
+import os
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+# Offline benchmark for api/webhook.py. Seeds the fake spreadsheet from
+# fake_backend with N rows of history, replays scripted conversations
+# through process_update() and reports throughput, per-step latency and
+# Sheets/Telegram call counts.
+#
+#   python bench/bench.py --rows 1000 100000 1000000 --chats 20 --rounds 5
+#
+# webhook still reads its config from the environment (LOCAL_STORE,
+# STATE_BACKEND, ...), so the same run can compare configurations. Each
+# --rows size runs in its own process because webhook keeps module state.
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+sys.path[:0] = [HERE, os.path.join(HERE, "..", "api")]
+
+from fake_backend import FakeSheets, FakeTelegram
+
+ACCOUNTS = ["Cash", "Bank", "Card"]
+CATEGORIES = ["Food", "Rent", "Transport", "Fun", "Bills"]
+
+CONVERSATIONS = {
+    "Income": ["Income", "Cash", "250000", "skip"],
+    "Expense": ["Expense", "Cash", "12000", "Food", "lunch"],
+    "Transfer": ["Transfer", "Bank", "Card", "5000"],
+    "Balance": ["Balance"],
+    "Spending": ["Spending", "This Week"]
+}
+
+CHAT_BASE = 1000
+
+
+def history(rows):
+
+    # a year of rows up to now: every fifth an income, the rest expenses,
+    # so every account stays well in credit
+
+    end = time.time()
+    start = end - 365 * 86400
+    step = (end - start) / max(rows, 1)
+
+    for i in range(rows):
+
+        ts = time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime(start + i * step + 7 * 3600))
+        account = ACCOUNTS[i % len(ACCOUNTS)]
+
+        if i % 5 == 0:
+            yield [ts, "Income", "1000000", "", account, ""]
+        else:
+            yield [ts, "Expense", str(1000 + i * 7919 % 49000), CATEGORIES[i % len(CATEGORIES)], account, "seed"]
+
+
+def percentile(sorted_values, q):
+
+    if not sorted_values:
+        return 0.0
+
+    return sorted_values[min(len(sorted_values) - 1, int(q * len(sorted_values)))]
+
+
+def fake_webhook(rows, sheets_latency, telegram_latency):
+
+    # imports webhook wired to fake backends, with rows of history in Sheet1
+
+    os.environ.setdefault("SHEET_ID", "bench")
+    os.environ.setdefault("BOT_TOKEN", "bench")
+
+    import webhook
+
+    sheets = FakeSheets(sheets_latency)
+
+    sheets.tab("Sheet1").append(["Date", "Type", "Amount", "Category", "Account", "Note"])
+    sheets.tab("Sheet1").extend(history(rows))
+    sheets.tab("Accounts").extend([["Account"]] + [[a] for a in ACCOUNTS])
+    sheets.tab("Categories").extend([["Category"]] + [[c] for c in CATEGORIES])
+
+    service = sheets.service()
+    telegram = FakeTelegram(telegram_latency)
+
+    webhook.get_service = lambda: service
+    webhook.get_telegram_session = lambda: telegram
+
+    return webhook, sheets, telegram
+
+
+def run(rows, chats, rounds, threads, sheets_latency, telegram_latency):
+
+    webhook, sheets, telegram = fake_webhook(rows, sheets_latency, telegram_latency)
+
+    # the first update pays for reading the history
+    started = time.perf_counter()
+    webhook.process_update(CHAT_BASE, "Balance")
+    cold = time.perf_counter() - started
+
+    cold_calls = dict(sheets.calls)
+
+    sheets.calls.clear()
+    telegram.calls.clear()
+
+    latencies = {}
+    errors = [0]
+    lock = threading.Lock()
+
+    def replay(chat_id):
+
+        for name, script in CONVERSATIONS.items():
+
+            for i, text in enumerate(script):
+
+                started = time.perf_counter()
+
+                try:
+                    webhook.process_update(chat_id, text)
+                except Exception as e:
+                    print("ERROR:", e, file=sys.stderr)
+                    with lock:
+                        errors[0] += 1
+
+                elapsed = time.perf_counter() - started
+
+                with lock:
+                    latencies.setdefault(f"{name} {i + 1}/{len(script)}", []).append(elapsed)
+
+    started = time.perf_counter()
+
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        list(pool.map(replay, [CHAT_BASE + i % chats for i in range(chats * rounds)]))
+
+    wall = time.perf_counter() - started
+
+    updates = sum(len(v) for v in latencies.values())
+
+    steps = {}
+
+    for label, values in latencies.items():
+
+        values.sort()
+
+        steps[label] = {
+            "count": len(values),
+            "mean_ms": sum(values) / len(values) * 1000,
+            "p50_ms": percentile(values, 0.50) * 1000,
+            "p95_ms": percentile(values, 0.95) * 1000,
+            "p99_ms": percentile(values, 0.99) * 1000
+        }
+
+    return {
+        "rows": rows,
+        "chats": chats,
+        "threads": threads,
+        "cold_start_ms": cold * 1000,
+        "cold_start_sheets_calls": cold_calls,
+        "updates": updates,
+        "errors": errors[0],
+        "seconds": wall,
+        "updates_per_second": updates / wall if wall else 0.0,
+        "sheets_calls": dict(sheets.calls),
+        "sheets_calls_per_update": sum(sheets.calls.values()) / updates if updates else 0.0,
+        "telegram_calls": dict(telegram.calls),
+        "steps": steps
+    }
+
+
+def print_report(report):
+
+    print(f"== {report['rows']:,} rows, {report['chats']} chats, {report['threads']} threads")
+    print(f"cold start      {report['cold_start_ms']:10.1f} ms  {report['cold_start_sheets_calls']}")
+    print(f"updates         {report['updates']:10d}   errors {report['errors']}")
+    print(f"throughput      {report['updates_per_second']:10.1f} updates/s")
+    print(f"sheets calls    {report['sheets_calls_per_update']:10.2f} per update  {report['sheets_calls']}")
+    print(f"telegram calls  {report['telegram_calls']}")
+    print()
+    print(f"{'step':<16}{'count':>8}{'mean ms':>10}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}")
+
+    for label, step in report["steps"].items():
+        print(
+            f"{label:<16}{step['count']:>8}{step['mean_ms']:>10.2f}"
+            f"{step['p50_ms']:>10.2f}{step['p95_ms']:>10.2f}{step['p99_ms']:>10.2f}"
+        )
+
+    print()
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description="Replay conversations against webhook with fake backends")
+    parser.add_argument("--rows", type=int, nargs="+", default=[1000, 10000, 100000])
+    parser.add_argument("--chats", type=int, default=10)
+    parser.add_argument("--rounds", type=int, default=5, help="conversation scripts per chat")
+    parser.add_argument("--threads", type=int, default=1)
+    parser.add_argument("--sheets-latency", type=float, default=0.0, help="seconds per Sheets call")
+    parser.add_argument("--telegram-latency", type=float, default=0.0, help="seconds per Telegram call")
+    parser.add_argument("--json", action="store_true", help="print the reports as JSON")
+
+    args = parser.parse_args()
+
+    reports = []
+
+    for rows in args.rows:
+
+        if len(args.rows) == 1:
+
+            reports.append(run(rows, args.chats, args.rounds, args.threads, args.sheets_latency, args.telegram_latency))
+            continue
+
+        argv = [
+            sys.executable, os.path.abspath(__file__),
+            "--rows", str(rows),
+            "--chats", str(args.chats),
+            "--rounds", str(args.rounds),
+            "--threads", str(args.threads),
+            "--sheets-latency", str(args.sheets_latency),
+            "--telegram-latency", str(args.telegram_latency),
+            "--json"
+        ]
+
+        output = subprocess.run(argv, check=True, stdout=subprocess.PIPE, text=True).stdout
+
+        reports.extend(json.loads(output))
+
+    if args.json:
+
+        print(json.dumps(reports, indent=2))
+        return
+
+    for report in reports:
+        print_report(report)
+
+
+if __name__ == "__main__":
+    main()
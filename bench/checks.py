@@ -0,0 +1,351 @@
+import os
+import sys
+import tempfile
+import threading
+from datetime import datetime, timezone
+
+# Regression checks for api/webhook.py on the fake backends from bench.py:
+#
+#   python bench/checks.py
+#
+# Each check starts from an empty spreadsheet and raises AssertionError
+# when webhook misbehaves.
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from bench import fake_webhook
+
+CHECKS = []
+
+
+def check(fn):
+
+    CHECKS.append(fn)
+    return fn
+
+
+def fresh(rows=()):
+
+    # webhook on a new fake spreadsheet holding rows under the header
+
+    webhook, sheets, telegram = fake_webhook(0, 0.0, 0.0)
+
+    sheets.tab("Sheet1").extend([list(row) for row in rows])
+
+    webhook.tx_reset()
+    webhook.invalidate_list("Accounts!A:A")
+    webhook.invalidate_list("Categories!A:A")
+
+    return webhook, sheets, telegram
+
+
+@check
+def month_boundary_in_wib():
+
+    # 03:00 WIB on the 1st is still the previous day in UTC
+    webhook, _, _ = fresh([
+        ["2026-01-31 10:00:00", "Expense", "50", "Food", "Cash", ""],
+        ["2026-02-01 03:00:00", "Expense", "100", "Food", "Cash", ""]
+    ])
+
+    start = datetime(2026, 2, 1, tzinfo=webhook.WIB)
+    end = datetime(2026, 3, 1, tzinfo=webhook.WIB)
+
+    from_rollup = webhook.get_all_expense_data(start, end)
+    from_rows = webhook.get_all_expense_data(start, end.replace(second=1))
+
+    assert from_rollup == ([("Food", 100)], 100), from_rollup
+    assert from_rows == from_rollup, from_rows
+
+    # the same month bounds given in UTC
+    utc = webhook.get_all_expense_data(start.astimezone(timezone.utc), end.astimezone(timezone.utc))
+
+    assert utc == from_rollup, utc
+
+
+def transactions(sheets, title):
+
+    return [row for row in sheets.tab(title)[1:] if any(row)]
+
+
+@check
+def quick_clean_archives_past_blank_pages():
+
+    # column G stands in for anything kept beside the transactions
+    rows = [["2026-01-0%d 10:00:00" % i, "Income", "10", "", "Cash", "n", "g"] for i in range(1, 4)]
+
+    webhook, sheets, _ = fresh(rows[:1] + [[]] * 5 + rows[1:])
+    webhook.CLEAN_CHUNK_ROWS = 2
+
+    archive = webhook.quick_clean()
+
+    assert transactions(sheets, archive) == rows, sheets.tab(archive)
+    assert transactions(sheets, "Sheet1") == [], sheets.tab("Sheet1")
+
+
+@check
+def export_reads_past_blank_pages():
+
+    rows = [["2026-01-0%d 10:00:00" % i, "Income", "10", "", "Cash", "n"] for i in range(1, 4)]
+
+    webhook, _, _ = fresh(rows[:1] + [[]] * 5 + rows[1:])
+    webhook.EXPORT_PAGE_ROWS = 2
+
+    fileobj, count = webhook.export_csv()
+    exported = fileobj.read().decode("utf-8").splitlines()
+
+    assert count == 3, count
+    assert exported[1:] == [",".join(row) for row in rows], exported
+
+
+@check
+def quick_clean_keeps_concurrent_appends():
+
+    # another chat appends just as the archive is about to clear Sheet1;
+    # the row must end up either archived or left in Sheet1
+    webhook, sheets, _ = fresh([["2026-01-01 10:00:00", "Income", "10", "", "Cash", "n"]] * 20)
+    webhook.CLEAN_CHUNK_ROWS = 5
+
+    call = sheets.call
+    racers = []
+
+    def racing_call(method, fn):
+
+        if method == "values.clear" and not racers:
+
+            racers.append(threading.Thread(target=webhook.add_transaction, args=("Income", 5, "", "Cash", "racing")))
+            racers[0].start()
+            racers[0].join(0.2)
+
+        return call(method, fn)
+
+    sheets.call = racing_call
+
+    archive = webhook.quick_clean()
+    racers[0].join()
+
+    kept = transactions(sheets, archive) + transactions(sheets, "Sheet1")
+
+    assert len(kept) == 21, len(kept)
+
+
+@check
+def rollup_persists_again_after_quick_clean():
+
+    webhook, sheets, _ = fresh([["2026-01-01 10:00:00", "Income", "10", "", "Cash", ""]] * 32)
+
+    persist_rows = webhook.ROLLUP_PERSIST_ROWS
+    webhook.ROLLUP_PERSIST_ROWS = 10
+
+    try:
+
+        for _ in range(2):
+            webhook.calculate_account_balance()
+
+        webhook.quick_clean()
+
+        for _ in range(15):
+            webhook.add_transaction("Income", 5, "", "Cash")
+
+        # a full read of the cleared sheet, then a delta sync that persists
+        for _ in range(2):
+            webhook.calculate_account_balance()
+
+    finally:
+        webhook.ROLLUP_PERSIST_ROWS = persist_rows
+
+    # the header row records how many Sheet1 rows the tab covers
+    assert sheets.tab("Rollup")[0][6] == "16", sheets.tab("Rollup")[0]
+
+
+@check
+def sync_past_the_initial_grid():
+
+    # appends grow the grid only to the last row written, so the row
+    # after it is outside the grid
+    webhook, sheets, _ = fresh([["2026-01-01 10:00:00", "Income", "10", "", "Cash", ""]] * 1000)
+
+    for cold in (False, True):
+
+        if cold:
+
+            # the same from the Rollup tab after a restart
+            webhook.rebuild_rollup()
+            webhook.tx_reset()
+
+        webhook.add_transaction("Income", 5, "", "Cash")
+
+        # the second sync has nothing new to read past the last row
+        for _ in range(2):
+            assert webhook.calculate_account_balance()[0]["Cash"] == 10005 + 11 * cold, cold
+
+        webhook.add_transaction("Income", 5, "", "Cash")
+        sheets.tab("Sheet1").append(["2026-01-02 10:00:00", "Income", "1", "", "Cash", ""])
+
+        assert webhook.calculate_account_balance()[0]["Cash"] == 10011 + 11 * cold, cold
+
+
+@check
+def local_store_rolls_back_failed_writes():
+
+    webhook, _, _ = fresh()
+
+    with tempfile.TemporaryDirectory() as tmp:
+
+        store = webhook.LocalStore(os.path.join(tmp, "local.db"))
+
+        try:
+            store.record_transactions([("2026-01-01 10:00:00", "Income")])
+        except ValueError:
+            pass
+
+        store.record_transactions([("2026-01-01 10:00:00", "Income", 10, "", "Cash", "")])
+
+        assert store.balances() == {"Cash": 10}, store.balances()
+
+
+@check
+def local_store_seeds_once_across_processes():
+
+    # a second process finishes seeding while the first reads the sheet
+    webhook, _, _ = fresh([["2026-01-01 10:00:00", "Income", "10", "", "Cash", ""]])
+
+    with tempfile.TemporaryDirectory() as tmp:
+
+        path = os.path.join(tmp, "local.db")
+        first, second = webhook.LocalStore(path), webhook.LocalStore(path)
+
+        get_sheets = webhook.get_sheets
+
+        def racing_get_sheets(range_names):
+
+            webhook.get_sheets = get_sheets
+            second.seed()
+            return get_sheets(range_names)
+
+        webhook.get_sheets = racing_get_sheets
+
+        try:
+            first.seed()
+        finally:
+            webhook.get_sheets = get_sheets
+
+        assert first.balances() == {"Cash": 10}, first.balances()
+
+
+@check
+def local_store_syncs_each_entry_once():
+
+    # two syncers on one store, e.g. sync_forever and a CLI drain loop
+    webhook, sheets, _ = fresh()
+
+    with tempfile.TemporaryDirectory() as tmp:
+
+        store = webhook.LocalStore(os.path.join(tmp, "local.db"))
+        store.record_transactions([("2026-01-01 10:00:00", "Income", 10, "", "Cash", "")])
+
+        sheets.latency = 0.02
+
+        def drain():
+
+            while store.sync_once():
+                pass
+
+        syncers = [threading.Thread(target=drain) for _ in range(2)]
+
+        for syncer in syncers:
+            syncer.start()
+
+        for syncer in syncers:
+            syncer.join()
+
+        assert len(transactions(sheets, "Sheet1")) == 1, sheets.tab("Sheet1")
+
+
+@check
+def rows_without_amounts_still_block_deletes():
+
+    webhook, _, _ = fresh([
+        ["2026-01-01 10:00:00", "Expense", "n/a", "Food", "Cash", ""],
+        ["2026-01-01 10:00:00", "Expense", "5", "Rent"]
+    ])
+
+    for restored in (False, True):
+
+        if restored:
+
+            # the same answers after a cold start from the Rollup tab
+            webhook.rebuild_rollup()
+            webhook.tx_reset()
+
+        assert not webhook.delete_account("Cash"), restored
+        assert not webhook.delete_category("food"), restored
+        assert not webhook.delete_category("Rent"), restored
+
+    assert webhook.get_all_expense_data() == ([], 0), webhook.get_all_expense_data()
+
+    # and the same in a local store seeded from that sheet
+    with tempfile.TemporaryDirectory() as tmp:
+
+        store = webhook.LocalStore(os.path.join(tmp, "local.db"))
+        store.seed()
+
+        assert not store.delete_name("Accounts!A:A", "Cash")
+        assert not store.delete_name("Categories!A:A", "food")
+        assert not store.delete_name("Categories!A:A", "Rent")
+
+        store.rebuild_rollup()
+
+        assert store.balances() == {}, store.balances()
+        assert store.expense_totals() == [], store.expense_totals()
+
+
+@check
+def import_skips_only_a_real_header():
+
+    webhook, sheets, _ = fresh()
+
+    headed = webhook.import_csv(["Date,Type,Amount,Category,Account,Note\n", "2026-01-01,Income,10,,Cash,\n"])
+
+    assert (headed["imported"], headed["rejected"]) == (1, []), headed
+
+    # no header: a bad first row is reported like any other
+    bare = webhook.import_csv(["2026-01-01,Income,lots,,Cash,\n", "2026-01-02,Income,10,,Cash,\n"])
+
+    assert bare["imported"] == 1, bare
+    assert [line_no for line_no, _ in bare["rejected"]] == [1], bare
+
+    assert len(transactions(sheets, "Sheet1")) == 2, sheets.tab("Sheet1")
+
+
+@check
+def import_converts_offsets_to_wib():
+
+    webhook, sheets, _ = fresh()
+
+    webhook.import_csv(["2026-01-01T10:00:00+00:00,Income,10,,Cash,\n", "2026-01-01 10:00:00,Income,10,,Cash,\n"])
+
+    dates = [row[0] for row in transactions(sheets, "Sheet1")]
+
+    assert dates == ["2026-01-01 17:00:00", "2026-01-01 10:00:00"], dates
+
+
+def main():
+
+    failed = 0
+
+    for fn in CHECKS:
+
+        try:
+            fn()
+        except Exception as e:
+            failed += 1
+            print(f"FAIL {fn.__name__}: {type(e).__name__}: {e}")
+        else:
+            print(f"ok   {fn.__name__}")
+
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,369 @@
+import json
+import re
+import threading
+import time
+from collections import Counter
+
+import httplib2
+from googleapiclient.errors import HttpError
+
+
+# In-process stand-ins for the parts of the Sheets and Telegram APIs that
+# api/webhook.py uses. Both count every call and can sleep a fixed latency
+# per call, so a benchmark sees realistic call counts without the network.
+
+# rows in a new tab's grid, as in Sheets
+GRID_ROWS = 1000
+
+
+def column_index(letters):
+
+    n = 0
+
+    for ch in letters:
+        n = n * 26 + ord(ch) - 64
+
+    return n - 1
+
+
+def parse_range(range_name):
+
+    # "Tab!A2:F10", "'Some Tab'!A:A", "Tab!A1" ->
+    # (tab, first row, end row or None, first column, end column), 0-based
+
+    tab, _, cells = range_name.partition("!")
+
+    match = re.fullmatch(r"([A-Z]+)(\d*)(?::([A-Z]+)(\d*))?", cells)
+
+    c1, r1, c2, r2 = match.groups()
+
+    first_row = int(r1) - 1 if r1 else 0
+
+    if c2 is None:
+
+        c2 = c1
+        end_row = first_row + 1 if r1 else None
+
+    else:
+        end_row = int(r2) if r2 else None
+
+    return tab.strip("'"), first_row, end_row, column_index(c1), column_index(c2) + 1
+
+
+def cell(value):
+
+    # RAW input comes back as the formatted string
+    return "" if value is None else str(value)
+
+
+def trimmed(rows):
+
+    out = []
+
+    for row in rows:
+
+        end = len(row)
+
+        while end and row[end - 1] == "":
+            end -= 1
+
+        out.append(row[:end])
+
+    while out and not out[-1]:
+        out.pop()
+
+    return out
+
+
+class FakeRequest:
+
+    def __init__(self, sheets, method, fn):
+
+        self.sheets = sheets
+        self.method = method
+        self.fn = fn
+
+    def execute(self, *args, **kwargs):
+
+        return self.sheets.call(self.method, self.fn)
+
+
+class FakeSheets:
+
+    # tabs hold lists of string rows; one lock stands in for the server.
+    # A tab's grid is GRID_ROWS or its row count, whichever is larger, less
+    # any rows deleted since; reads starting past it fail as in Sheets
+
+    def __init__(self, latency=0.0):
+
+        self.latency = latency
+        self.tabs = {}
+        self.grids = {}
+        self.sheet_ids = {}
+        self.calls = Counter()
+        self.lock = threading.Lock()
+
+    def call(self, method, fn):
+
+        self.calls[method] += 1
+
+        if self.latency:
+            time.sleep(self.latency)
+
+        with self.lock:
+            return fn()
+
+    def tab(self, title):
+
+        if title not in self.tabs:
+
+            self.tabs[title] = []
+            self.grids[title] = GRID_ROWS
+            self.sheet_ids[title] = len(self.sheet_ids)
+
+        return self.tabs[title]
+
+    def grid_rows(self, title):
+
+        rows = self.tab(title)
+
+        return max(self.grids[title], len(rows))
+
+    def read(self, range_name):
+
+        title, first_row, end_row, first_col, end_col = parse_range(range_name)
+
+        if first_row >= self.grid_rows(title):
+
+            message = f"Range ({range_name}) exceeds grid limits. Max rows: {self.grid_rows(title)}"
+
+            raise HttpError(
+                httplib2.Response({"status": 400, "reason": "Bad Request"}),
+                json.dumps({"error": {"code": 400, "message": message, "status": "INVALID_ARGUMENT"}}).encode()
+            )
+
+        rows = self.tab(title)[first_row:end_row]
+
+        return trimmed([row[first_col:end_col] for row in rows])
+
+    def write(self, title, first_row, first_col, values):
+
+        rows = self.tab(title)
+
+        while len(rows) < first_row + len(values):
+            rows.append([])
+
+        for offset, values_row in enumerate(values):
+
+            row = rows[first_row + offset]
+
+            if len(row) < first_col + len(values_row):
+                row.extend([""] * (first_col + len(values_row) - len(row)))
+
+            row[first_col:first_col + len(values_row)] = [cell(v) for v in values_row]
+
+    def service(self):
+
+        return FakeService(self)
+
+
+class FakeService:
+
+    def __init__(self, sheets):
+        self.sheets = sheets
+
+    def spreadsheets(self):
+        return FakeSpreadsheets(self.sheets)
+
+
+class FakeSpreadsheets:
+
+    def __init__(self, sheets):
+        self.sheets = sheets
+
+    def values(self):
+        return FakeValues(self.sheets)
+
+    def get(self, spreadsheetId=None, fields=None, **kwargs):
+
+        sheets = self.sheets
+
+        def run():
+
+            return {"sheets": [
+                {"properties": {
+                    "title": title,
+                    "sheetId": sheets.sheet_ids[title],
+                    "gridProperties": {"rowCount": sheets.grid_rows(title)}
+                }}
+                for title in sheets.tabs
+            ]}
+
+        return FakeRequest(sheets, "get", run)
+
+    def batchUpdate(self, spreadsheetId=None, body=None, **kwargs):
+
+        sheets = self.sheets
+
+        def run():
+
+            titles = {sheet_id: title for title, sheet_id in sheets.sheet_ids.items()}
+
+            for request in body["requests"]:
+
+                if "addSheet" in request:
+                    sheets.tab(request["addSheet"]["properties"]["title"])
+
+                elif "deleteDimension" in request:
+
+                    span = request["deleteDimension"]["range"]
+                    title = titles[span["sheetId"]]
+
+                    sheets.grids[title] = sheets.grid_rows(title) - (span["endIndex"] - span["startIndex"])
+                    del sheets.tabs[title][span["startIndex"]:span["endIndex"]]
+
+            return {}
+
+        return FakeRequest(sheets, "batchUpdate", run)
+
+
+class FakeValues:
+
+    def __init__(self, sheets):
+        self.sheets = sheets
+
+    def get(self, spreadsheetId=None, range=None, **kwargs):
+
+        sheets = self.sheets
+        range_name = range
+
+        def run():
+
+            rows = sheets.read(range_name)
+            return {"range": range_name, "values": rows} if rows else {"range": range_name}
+
+        return FakeRequest(sheets, "values.get", run)
+
+    def batchGet(self, spreadsheetId=None, ranges=(), **kwargs):
+
+        sheets = self.sheets
+
+        def run():
+
+            value_ranges = []
+
+            for range_name in ranges:
+
+                rows = sheets.read(range_name)
+                value_ranges.append({"range": range_name, "values": rows} if rows else {"range": range_name})
+
+            return {"valueRanges": value_ranges}
+
+        return FakeRequest(sheets, "values.batchGet", run)
+
+    def append(self, spreadsheetId=None, range=None, valueInputOption=None, body=None, **kwargs):
+
+        sheets = self.sheets
+        range_name = range
+
+        def run():
+
+            title, _, _, first_col, _ = parse_range(range_name)
+
+            rows = sheets.tab(title)
+
+            # the table ends at the last row with anything in it
+            end = len(rows)
+
+            while end and not any(rows[end - 1]):
+                end -= 1
+
+            del rows[end:]
+
+            values = body["values"]
+
+            sheets.write(title, end, first_col, values)
+
+            width = max((len(v) for v in values), default=1)
+            last_col = chr(65 + first_col + width - 1)
+
+            return {"updates": {
+                "updatedRange": f"{title}!{chr(65 + first_col)}{end + 1}:{last_col}{end + len(values)}",
+                "updatedRows": len(values)
+            }}
+
+        return FakeRequest(sheets, "values.append", run)
+
+    def update(self, spreadsheetId=None, range=None, valueInputOption=None, body=None, **kwargs):
+
+        sheets = self.sheets
+        range_name = range
+
+        def run():
+
+            title, first_row, _, first_col, _ = parse_range(range_name)
+            sheets.write(title, first_row, first_col, body["values"])
+            return {}
+
+        return FakeRequest(sheets, "values.update", run)
+
+    def clear(self, spreadsheetId=None, range=None, **kwargs):
+
+        sheets = self.sheets
+        range_name = range
+
+        def run():
+
+            title, first_row, end_row, first_col, end_col = parse_range(range_name)
+
+            # no range() in here: the range parameter shadows the builtin
+            for row in sheets.tab(title)[first_row:end_row]:
+
+                end = min(end_col, len(row))
+                row[first_col:end] = [""] * max(end - first_col, 0)
+
+            return {}
+
+        return FakeRequest(sheets, "values.clear", run)
+
+
+class FakeResponse:
+
+    status_code = 200
+
+    def __init__(self, result):
+        self.result = result
+
+    def json(self):
+        return {"ok": True, "result": self.result}
+
+
+class FakeTelegram:
+
+    # replaces the requests.Session from get_telegram_session(); keeps the
+    # last message per chat so a driver can check what the bot answered
+
+    def __init__(self, latency=0.0):
+
+        self.latency = latency
+        self.calls = Counter()
+        self.last = {}
+        self.lock = threading.Lock()
+
+    def post(self, url, json=None, data=None, files=None, timeout=None):
+
+        method = url.rsplit("/", 1)[-1]
+
+        if self.latency:
+            time.sleep(self.latency)
+
+        payload = json if json is not None else data or {}
+
+        with self.lock:
+
+            self.calls[method] += 1
+
+            if "chat_id" in payload:
+                self.last[payload["chat_id"]] = payload.get("text") or payload.get("caption", "")
+
+        return FakeResponse({"message_id": 1})
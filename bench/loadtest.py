@@ -0,0 +1,272 @@
+import argparse
+import json
+import os
+import sys
+import threading
+import time
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+# Load-test driver for the webhook HTTP server. Posts Telegram updates to
+# --url from --concurrency workers; all updates of one chat go out in order
+# from a single worker, so conversations stay valid while chats run in
+# parallel. Reports webhook response time and error rate.
+#
+#   python bench/loadtest.py --url http://127.0.0.1:8080/ --chats 200 --concurrency 32
+#   python bench/loadtest.py --fake --rows 100000 --updates updates.jsonl
+#   python bench/loadtest.py --fake --json > base.json
+#   python bench/loadtest.py --fake --compare base.json
+#
+# --updates reads one JSON object per line: a Telegram update, or
+# {"chat_id": ..., "text": ...}. Without it the bench.CONVERSATIONS scripts
+# are replayed for --chats chats. update_ids are renumbered unless
+# --keep-ids, so webhook's dedup does not drop a replayed log. Messages are
+# sent from --user-id, which a real server needs in ALLOWED_USERS.
+#
+# --fake serves webhook in-process on the fake backends from bench.py; the
+# server still follows SERVER_MODE, UPDATE_QUEUE_WORKERS etc.
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from bench import CHAT_BASE, CONVERSATIONS, fake_webhook, percentile
+
+
+def synthetic_updates(chats, rounds):
+
+    for i in range(chats * rounds):
+        for script in CONVERSATIONS.values():
+            for text in script:
+                yield {"chat_id": CHAT_BASE + i % chats, "text": text}
+
+
+def read_updates(path):
+
+    with open(path, encoding="utf-8") as f:
+
+        for line in f:
+
+            if line.strip():
+                yield json.loads(line)
+
+
+def make_update(entry, update_id, user_id, keep_ids):
+
+    if "message" not in entry:
+
+        entry = {
+            "update_id": update_id,
+            "message": {
+                "message_id": update_id,
+                "chat": {"id": entry["chat_id"], "type": "private"},
+                "from": {"id": user_id},
+                "date": int(time.time()),
+                "text": entry["text"]
+            }
+        }
+
+    elif not keep_ids or "update_id" not in entry:
+        entry = dict(entry, update_id=update_id)
+
+    return entry
+
+
+def by_chat(updates):
+
+    # chat id -> its updates in log order
+
+    chats = {}
+
+    for update in updates:
+        chats.setdefault(update["message"]["chat"]["id"], []).append(update)
+
+    return list(chats.values())
+
+
+def serve_fake(rows, sheets_latency, telegram_latency, user_id):
+
+    os.environ.setdefault("ALLOWED_USERS", str(user_id))
+
+    webhook, _, _ = fake_webhook(rows, sheets_latency, telegram_latency)
+
+    class QuietHandler(webhook.handler):
+
+        def log_message(self, *args):
+            pass
+
+    if webhook.SERVER_MODE == "threaded":
+        server = webhook.PooledHTTPServer(("127.0.0.1", 0), QuietHandler, webhook.SERVER_WORKERS)
+    else:
+        server = webhook.HTTPServer(("127.0.0.1", 0), QuietHandler)
+
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    # pay for the first full read of the seeded history before measuring
+    webhook.process_update(CHAT_BASE, "Balance")
+
+    return f"http://127.0.0.1:{server.server_address[1]}/"
+
+
+def run(url, conversations, concurrency, timeout):
+
+    latencies = []
+    statuses = {}
+    lock = threading.Lock()
+
+    def post(update):
+
+        request = urllib.request.Request(
+            url,
+            data=json.dumps(update).encode(),
+            headers={"Content-Type": "application/json"}
+        )
+
+        started = time.perf_counter()
+
+        try:
+
+            with urllib.request.urlopen(request, timeout=timeout) as response:
+
+                response.read()
+                status = str(response.status)
+
+        except urllib.error.HTTPError as e:
+            status = str(e.code)
+        except Exception as e:
+            status = type(e).__name__
+
+        elapsed = time.perf_counter() - started
+
+        with lock:
+
+            latencies.append(elapsed)
+            statuses[status] = statuses.get(status, 0) + 1
+
+    def replay(updates):
+
+        for update in updates:
+            post(update)
+
+    started = time.perf_counter()
+
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        list(pool.map(replay, conversations))
+
+    wall = time.perf_counter() - started
+
+    latencies.sort()
+
+    total = len(latencies)
+    errors = total - statuses.get("200", 0)
+
+    return {
+        "url": url,
+        "updates": total,
+        "chats": len(conversations),
+        "concurrency": concurrency,
+        "seconds": wall,
+        "requests_per_second": total / wall if wall else 0.0,
+        "errors": errors,
+        "error_rate": errors / total if total else 0.0,
+        "status": statuses,
+        "latency_ms": {
+            "mean": sum(latencies) / total * 1000 if total else 0.0,
+            "p50": percentile(latencies, 0.50) * 1000,
+            "p95": percentile(latencies, 0.95) * 1000,
+            "p99": percentile(latencies, 0.99) * 1000,
+            "max": latencies[-1] * 1000 if latencies else 0.0
+        }
+    }
+
+
+def print_report(report, baseline=None):
+
+    def row(label, value, old, unit):
+
+        line = f"{label:<14}{value:12.2f} {unit}"
+
+        if old is not None:
+
+            change = (value - old) / old * 100 if old else 0.0
+            line += f"   was {old:.2f} ({change:+.1f}%)"
+
+        print(line)
+
+    def old(*path):
+
+        value = baseline
+
+        for key in path:
+
+            if value is None:
+                return None
+
+            value = value.get(key)
+
+        return value
+
+    print(f"== {report['updates']} updates, {report['chats']} chats, concurrency {report['concurrency']} -> {report['url']}")
+
+    row("throughput", report["requests_per_second"], old("requests_per_second"), "req/s")
+    row("error rate", report["error_rate"] * 100, None if baseline is None else old("error_rate") * 100, "%")
+
+    for key in ("mean", "p50", "p95", "p99", "max"):
+        row(key, report["latency_ms"][key], old("latency_ms", key), "ms")
+
+    print(f"status        {report['status']}")
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description="Post Telegram updates at a webhook server and time the responses")
+    parser.add_argument("--url", default="http://127.0.0.1:8080/")
+    parser.add_argument("--fake", action="store_true", help="serve webhook in-process on fake backends")
+    parser.add_argument("--rows", type=int, default=10000, help="history rows for --fake")
+    parser.add_argument("--sheets-latency", type=float, default=0.0, help="seconds per Sheets call for --fake")
+    parser.add_argument("--telegram-latency", type=float, default=0.0, help="seconds per Telegram call for --fake")
+    parser.add_argument("--updates", help="JSON lines file of updates to replay")
+    parser.add_argument("--chats", type=int, default=50)
+    parser.add_argument("--rounds", type=int, default=2, help="conversation scripts per chat")
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--user-id", type=int, default=CHAT_BASE)
+    parser.add_argument("--keep-ids", action="store_true", help="send update_ids from the log unchanged")
+    parser.add_argument("--timeout", type=float, default=30)
+    parser.add_argument("--json", action="store_true", help="print the report as JSON")
+    parser.add_argument("--compare", help="JSON report of an earlier run to compare against")
+
+    args = parser.parse_args()
+
+    url = args.url
+
+    if args.fake:
+        url = serve_fake(args.rows, args.sheets_latency, args.telegram_latency, args.user_id)
+
+    entries = read_updates(args.updates) if args.updates else synthetic_updates(args.chats, args.rounds)
+
+    # start well clear of ids a live bot has already seen
+    first_id = int(time.time() * 1000)
+
+    updates = [
+        make_update(entry, first_id + i, args.user_id, args.keep_ids)
+        for i, entry in enumerate(entries)
+    ]
+
+    report = run(url, by_chat(updates), args.concurrency, args.timeout)
+
+    if args.json:
+
+        print(json.dumps(report, indent=2))
+        return
+
+    baseline = None
+
+    if args.compare:
+
+        with open(args.compare, encoding="utf-8") as f:
+            baseline = json.load(f)
+
+    print_report(report, baseline)
+
+
+if __name__ == "__main__":
+    main()